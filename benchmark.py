@@ -0,0 +1,364 @@
+"""
+Benchmarks for the ranked_pairs election engine.
+
+    python3 benchmark.py suite       # time the election over a grid of electorates
+    python3 benchmark.py parallel    # tally_parallel speedup by worker count
+    python3 benchmark.py startup --sqlite PATH        # persistence startup time
+    python3 benchmark.py startup --database-url URL   # same, on Postgres
+    python3 benchmark.py callbacks   # callback data encoding and decoding
+
+`suite` writes its results as JSON; pass a previous run as --baseline to
+exit with an error if any case got slower by more than --threshold.
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import queue
+import random
+import sys
+import time
+import uuid
+import warnings
+
+import telegram
+from telegram.ext import Dispatcher
+
+import check_persistence
+import electorates
+import ranked_pairs
+
+FUNCTIONS = {
+    "get_winners": ranked_pairs.get_winners,
+    "get_ranked_partitions": ranked_pairs.get_ranked_partitions,
+    "get_candidate_rankings": ranked_pairs.get_candidate_rankings,
+}
+
+def time_call(fn, *args, repeat=3, **kwargs):
+    """
+    best wall-clock time, in seconds, of 'repeat' calls to fn
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def case_name(function, generator, n_options, n_voters, abstention):
+    return "{}/{}/options={}/voters={}/abstention={}".format(
+        function, generator, n_options, n_voters, abstention)
+
+def run_suite(args):
+    grid = itertools.product(args.generators, args.options, args.voters, args.abstention)
+
+    cases = {}
+    for generator, n_options, n_voters, abstention in grid:
+        # seeded per electorate, so a case sees the same ballots whatever the grid
+        rng = random.Random("{}/{}/{}/{}/{}".format(args.seed, generator, n_options, n_voters, abstention))
+        ballots = electorates.GENERATORS[generator](rng, n_voters, n_options, abstention)
+
+        for function in args.functions:
+            name = case_name(function, generator, n_options, n_voters, abstention)
+            cases[name] = time_call(FUNCTIONS[function], ballots, repeat=args.repeat)
+            print("{:<80} {:>9.4f}s".format(name, cases[name]), file=sys.stderr)
+
+    return {
+        "python": platform.python_version(),
+        "numpy": ranked_pairs.np is not None,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "cases": cases,
+    }
+
+def find_regressions(results, baseline, threshold):
+    """
+    cases that took more than (1 + threshold) times as long as in the baseline
+    """
+    regressions = {}
+    for name, seconds in results["cases"].items():
+        before = baseline["cases"].get(name)
+        if before is not None and seconds > before * (1 + threshold):
+            regressions[name] = (before, seconds)
+    return regressions
+
+def bench_suite(args):
+    results = run_suite(args)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, (before, after) in sorted(regressions.items()):
+            print("REGRESSION {}: {:.4f}s -> {:.4f}s ({:+.0%})".format(
+                name, before, after, after / before - 1), file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+def bench_parallel(args):
+    rng = random.Random(args.seed)
+    ballots = electorates.impartial_culture(rng, args.voters, args.options)
+
+    print("{} voters, {} options, {} cores".format(args.voters, args.options, os.cpu_count()))
+    print("workers  seconds  speedup")
+
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        seconds = time_call(ranked_pairs.tally_parallel, ballots,
+            workers=workers, threshold=0, repeat=args.repeat)
+        if baseline is None:
+            baseline = seconds
+        print("{:>7}  {:>7.3f}  {:>6.2f}x".format(workers, seconds, baseline / seconds))
+
+def synthetic_state(rng, n_polls, n_users, votes_per_poll):
+    """
+    bot_data and user_data shaped like the bot's, with plain dicts standing
+    in for Poll and Vote so this doesn't need a bot token to import main
+    """
+    bot_data = {}
+    user_data = {}
+    for poll_idx in range(n_polls):
+        poll_id = "poll-{}".format(poll_idx)
+        owner = rng.randrange(n_users)
+        options = [ "option {}".format(i) for i in range(rng.randint(2, 6)) ]
+        votes = {}
+        for _ in range(votes_per_poll):
+            rankings = list(range(1, len(options) + 1))
+            rng.shuffle(rankings)
+            votes[rng.randrange(n_users)] = { "option_rankings": rankings, "status": 2 }
+        bot_data[poll_id] = { "question": "question {}?".format(poll_idx), "options": options,
+            "owner": owner, "votes": votes, "ongoing": rng.random() < 0.1 }
+        user_data.setdefault(owner, { "create_status": 0, "active_polls": set() })["active_polls"].add(poll_id)
+    return bot_data, user_data
+
+def time_startup(backend, **kwargs):
+    """
+    seconds for the calls Updater makes when it starts, plus fetching a
+    single poll as the first update to touch one would
+    """
+    start = time.perf_counter()
+    persistence = backend.make(**kwargs)
+    persistence.get_user_data()
+    persistence.get_chat_data()
+    bot_data = persistence.get_bot_data()
+    persistence.get_callback_data()
+    persistence.get_conversations("benchmark")
+    ready = time.perf_counter() - start
+    bot_data.get("poll-0")
+    first_poll = time.perf_counter() - start - ready
+    persistence._close() # without flushing; nothing changed
+    return ready, first_poll
+
+def time_persistence_pass(backend, user_id, **kwargs):
+    """
+    seconds Dispatcher.update_persistence takes, as PTB calls it after an
+    update from one of the stored users, and with no update, as after every
+    JobQueue job run (the second such pass too, once everything is fetched)
+    """
+    persistence = backend.make(**kwargs)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        dispatcher = Dispatcher(telegram.Bot("123:benchmark"), queue.Queue(), persistence=persistence)
+
+    user = telegram.User(user_id, "benchmark", False)
+    message = telegram.Message(1, datetime.datetime.now(), telegram.Chat(user_id, "private"), from_user=user)
+    seconds = []
+    for update in [ telegram.Update(1, message=message), None, None ]:
+        start = time.perf_counter()
+        dispatcher.update_persistence(update)
+        seconds.append(time.perf_counter() - start)
+    persistence._close() # without flushing; nothing changed
+    return seconds
+
+def bench_startup(args):
+    if args.database_url is not None:
+        backend = check_persistence.postgres_backend(args.database_url)
+    else:
+        backend = check_persistence.sqlite_backend(args.sqlite)
+
+    rng = random.Random(args.seed)
+    bot_data, user_data = synthetic_state(rng, args.polls, args.users, args.votes)
+    backend.reset()
+
+    print("{}: {} polls, {} users, {} votes per poll".format(backend.name, args.polls, args.users, args.votes))
+    print("{:<12} {:>10} {:>11} {:>12} {:>12} {:>12}".format(
+        "mode", "startup", "first poll", "update pass", "job pass", "again"))
+    for mode, kwargs in [
+        ("snapshot", {}),
+        ("incremental", { "incremental": True }),
+    ]:
+        kwargs["compression"] = args.compression
+        writer = backend.make(**kwargs)
+        writer.get_bot_data()
+        for user_id, data in user_data.items():
+            writer.user_data[user_id] = data
+            writer._mark_dirty("user_data", user_id)
+        for poll_id, poll in bot_data.items():
+            writer.bot_data[poll_id] = poll
+            writer._mark_dirty("bot_data", poll_id)
+        writer.flush()
+
+        best = None
+        for _ in range(args.repeat):
+            result = time_startup(backend, **kwargs)
+            if best is None or result[0] < best[0]:
+                best = result
+        passes = time_persistence_pass(backend, next(iter(user_data)), **kwargs)
+        print("{:<12} {:>9.3f}s {:>10.4f}s {:>11.4f}s {:>11.3f}s {:>11.3f}s".format(mode, *best, *passes))
+
+# --- callback data as it was before poll handles, for comparison; do not optimize ---
+
+def legacy_encode_option(poll_id, opt_idx):
+    return "2:{}:{}".format(poll_id, opt_idx)
+
+def legacy_decode_callback(s):
+    if s[0] == "0":
+        return 0, s[2:]
+    if s[0] == "1":
+        return 1, s[2:]
+    elif s[0] == "2":
+        sep = s.rfind(":")
+        return 2, s[2:sep], int(s[sep+1:])
+    elif s[0] == "3":
+        sep = s.rfind(":")
+        return 3, s[2:sep], int(s[sep+1:])
+    elif s[0] == "4":
+        return 4, s[2:]
+    elif s[0] == "5":
+        return 5, s[2:]
+    elif s[0] == "6":
+        return 6, s[2:]
+    elif s[0] == "7":
+        return 7, s[2:]
+    elif s[0] == "8":
+        return 8, s[2:]
+
+def bench_callbacks(args):
+    # main reads these when imported; nothing here talks to Telegram
+    os.environ.setdefault("BOT_TOKEN", "benchmark")
+    os.environ.setdefault("BOT_USERNAME", "@benchmark")
+    import main
+
+    rng = random.Random(args.seed)
+    poll_ids = [ str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(100) ]
+    handles = [ main.poll_handle(poll_id) for poll_id in poll_ids ]
+    # a ballot's worth of option buttons for each poll, the most common callback
+    legacy = [ legacy_encode_option(poll_id, i) for poll_id in poll_ids for i in range(args.options) ]
+    compact = [ main.encode_option(handle, i) for handle in handles for i in range(args.options) ]
+
+    def encode_all(encode, keys):
+        for key in keys:
+            for i in range(args.options):
+                encode(key, i)
+
+    def decode_all(decode, data):
+        for s in data:
+            decode(s)
+
+    cases = [
+        ("encode legacy", len(legacy), time_call(encode_all, legacy_encode_option, poll_ids, repeat=args.repeat)),
+        ("encode compact", len(compact), time_call(encode_all, main.encode_option, handles, repeat=args.repeat)),
+        ("decode legacy (old decoder)", len(legacy), time_call(decode_all, legacy_decode_callback, legacy, repeat=args.repeat)),
+        ("decode legacy (new decoder)", len(legacy), time_call(decode_all, main.decode_callback, legacy, repeat=args.repeat)),
+        ("decode compact", len(compact), time_call(decode_all, main.decode_callback, compact, repeat=args.repeat)),
+    ]
+
+    print("bytes per option button: legacy {:.1f}, compact {:.1f}".format(
+        sum(map(len, legacy)) / len(legacy), sum(map(len, compact)) / len(compact)))
+    print("{:<30} {:>12}".format("case", "per second"))
+    for name, n, seconds in cases:
+        print("{:<30} {:>12.0f}".format(name, n / seconds))
+
+    index = main.PollIndex()
+    bot_data = { poll_id: None for poll_id in poll_ids }
+    seconds = time_call(lambda: [ index.lookup(bot_data, handle) for handle in handles ], repeat=args.repeat)
+    print("{:<30} {:>12.0f}".format("handle lookup", len(handles) / seconds))
+
+def int_list(s):
+    return [ int(x) for x in s.split(",") ]
+
+def float_list(s):
+    return [ float(x) for x in s.split(",") ]
+
+def choice_list(choices):
+    def parse(s):
+        values = s.split(",")
+        for value in values:
+            if value not in choices:
+                raise argparse.ArgumentTypeError("unknown choice {!r} (choose from {})".format(
+                    value, ", ".join(choices)))
+        return values
+    return parse
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the ranked_pairs election engine.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    suite = subparsers.add_parser("suite",
+        help="time get_winners, get_ranked_partitions and get_candidate_rankings over a grid of electorates")
+    suite.add_argument("--functions", type=choice_list(FUNCTIONS), default=list(FUNCTIONS),
+        help="comma-separated (default: all)")
+    suite.add_argument("--generators", type=choice_list(electorates.GENERATORS),
+        default=list(electorates.GENERATORS), help="comma-separated (default: all)")
+    suite.add_argument("--options", type=int_list, default=[5, 10, 25],
+        help="comma-separated candidate counts (default: 5,10,25)")
+    suite.add_argument("--voters", type=int_list, default=[100, 1000, 10000],
+        help="comma-separated voter counts (default: 100,1000,10000)")
+    suite.add_argument("--abstention", type=float_list, default=[0.0, 0.5],
+        help="comma-separated per-option abstention rates (default: 0.0,0.5)")
+    suite.add_argument("--repeat", type=int, default=3)
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--output", help="write JSON results here instead of stdout")
+    suite.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    suite.add_argument("--threshold", type=float, default=0.25,
+        help="fail if a case is this much slower than the baseline (default: %(default)s, i.e. 25%%)")
+    suite.set_defaults(run=bench_suite)
+
+    parallel = subparsers.add_parser("parallel",
+        help="how tally_parallel scales with the number of worker processes")
+    parallel.add_argument("--voters", type=int, default=200000)
+    parallel.add_argument("--options", type=int, default=10)
+    parallel.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parallel.add_argument("--repeat", type=int, default=3)
+    parallel.add_argument("--seed", type=int, default=0)
+    parallel.set_defaults(run=bench_parallel)
+
+    startup = subparsers.add_parser("startup",
+        help="persistence startup time, snapshot vs incremental, on a synthetic state")
+    database = startup.add_mutually_exclusive_group(required=True)
+    database.add_argument("--sqlite", help="WARNING: this file is overwritten")
+    database.add_argument("--database-url",
+        help="WARNING: the persistence tables in this database are overwritten")
+    startup.add_argument("--polls", type=int, default=100000)
+    startup.add_argument("--users", type=int, default=20000)
+    startup.add_argument("--votes", type=int, default=5, help="votes per poll (default: %(default)s)")
+    startup.add_argument("--compression", choices=["zlib", "zstd"])
+    startup.add_argument("--repeat", type=int, default=3)
+    startup.add_argument("--seed", type=int, default=0)
+    startup.set_defaults(run=bench_startup)
+
+    callbacks = subparsers.add_parser("callbacks",
+        help="callback data encoding and decoding throughput, before and after poll handles")
+    callbacks.add_argument("--options", type=int, default=10, help="options per poll (default: %(default)s)")
+    callbacks.add_argument("--repeat", type=int, default=5)
+    callbacks.add_argument("--seed", type=int, default=0)
+    callbacks.set_defaults(run=bench_callbacks)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Differential check of the ranked_pairs election engines.
+
+Runs randomly generated electorates, plus every tiny electorate outright,
+through a frozen copy of the original Pair/bfs implementation (including
+its -1 abstention trick for ranking) and through every alternative way
+ranked_pairs can tally and rank, and fails if any of them disagree. It
+then times the engines on a few large electorates and fails if one is
+slower than the reference.
+
+    python3 check_engines.py [--cases 2000] [--seed 0]
+
+Scores are assumed to be non-negative, as the bot always produces; the
+reference's abstention trick only ranks such ballots correctly.
+"""
+
+import argparse
+import copy
+import itertools
+import random
+import sys
+import time
+
+import electorates
+import ranked_pairs
+
+# --- reference implementation, as originally written; do not optimize ---
+
+class ReferencePair:
+    def __init__(self, candidateA, candidateB):
+        self.min_candidate = min(candidateA, candidateB)
+        self.max_candidate = max(candidateA, candidateB)
+        self.min_cand_votes = 0
+        self.max_cand_votes = 0
+
+    def process_ballot(self, ballot):
+        if ballot[self.min_candidate] > ballot[self.max_candidate]:
+            self.min_cand_votes += 1
+        elif ballot[self.min_candidate] < ballot[self.max_candidate]:
+            self.max_cand_votes += 1
+
+    def get_winner(self):
+        if self.min_cand_votes > self.max_cand_votes:
+            return self.min_candidate
+        elif self.min_cand_votes < self.max_cand_votes:
+            return self.max_candidate
+        else:
+            return None
+
+    def get_loser(self):
+        if self.get_winner() == self.min_candidate:
+            return self.max_candidate
+        elif self.get_winner() == self.max_candidate:
+            return self.min_candidate
+        else:
+            return None
+
+    def get_winner_votes(self):
+        return max(self.min_cand_votes, self.max_cand_votes)
+    def get_loser_votes(self):
+        return min(self.min_cand_votes, self.max_cand_votes)
+
+    def __gt__(self, other):
+        return self.get_winner_votes() > other.get_winner_votes() \
+            or (self.get_winner_votes() == other.get_winner_votes() and \
+            self.get_loser_votes() < other.get_loser_votes())
+
+def reference_bfs(graph, source):
+    to_explore = {source}
+    visited = set()
+    while len(to_explore) > 0:
+        v = to_explore.pop()
+        if v not in visited:
+            to_explore.update(graph[v])
+            visited.add(v)
+    return visited
+
+def reference_get_sources(graph):
+    sources = set(graph.keys())
+    for losers in graph.values():
+        sources -= losers
+    return sources
+
+def reference_get_winners(ballots):
+    n_options = len(ballots[0])
+
+    pairs = [ ]
+    for a in range(n_options):
+        for b in range(a):
+            pairs.append(ReferencePair(a, b))
+
+    for pair in pairs:
+        for ballot in ballots:
+            pair.process_ballot(ballot)
+
+    ranked_pairs = sorted(pairs, reverse=True)
+
+    graph = { n: set() for n in range(n_options) }
+    for pair in ranked_pairs:
+        winner, loser = pair.get_winner(), pair.get_loser()
+        if (winner is not None) and winner not in reference_bfs(graph, loser):
+            graph[winner].add(loser)
+
+    return reference_get_sources(graph)
+
+def reference_get_ranked_partitions(ballots):
+    n_options = len(ballots[0])
+    ballots_copy = copy.deepcopy(ballots)
+
+    already_won = set()
+    result = []
+
+    while True:
+        winners = reference_get_winners(ballots_copy)
+        if len(winners.intersection(already_won)) > 0:
+            break
+
+        already_won.update(winners)
+        result.append(winners)
+
+        for w in winners:
+            for ballot in ballots_copy:
+                ballot[w] = -1
+
+    assert len(already_won) == n_options
+    return result
+
+# --- engines under test: each turns ballots into a preference matrix ---
+
+def tally_incremental(ballots):
+    """
+    add every ballot one at a time, as Poll does, along with some decoys
+    that are retracted again
+    """
+    rng = random.Random(len(ballots))
+    matrix = ranked_pairs.empty_matrix(len(ballots[0]))
+    decoys = [ rng.choice(ballots) for _ in range(len(ballots) // 2) ]
+    for ballot in decoys:
+        ranked_pairs.add_ballot(matrix, ballot)
+    for ballot in ballots:
+        ranked_pairs.add_ballot(matrix, ballot)
+    for ballot in decoys:
+        ranked_pairs.add_ballot(matrix, ballot, -1)
+    return matrix
+
+ENGINES = {
+    "default": ranked_pairs.tally,
+    "python": lambda ballots: ranked_pairs.tally_python(ranked_pairs.collapse_ballots(ballots)),
+    "weighted": lambda ballots: ranked_pairs.tally_weighted(ranked_pairs.collapse_ballots(ballots)),
+    "stream": lambda ballots: ranked_pairs.tally_stream(iter(ballots), chunk_size=3),
+    "incremental": tally_incremental,
+}
+if ranked_pairs.np is not None:
+    ENGINES["numpy"] = ranked_pairs.tally_numpy
+
+# spawns a process pool per call, so only checked on every PARALLEL_EVERY'th case
+PARALLEL_EVERY = 50
+
+def tally_parallel(ballots):
+    return ranked_pairs.tally_parallel(ballots, workers=2, threshold=0)
+
+def results_from_matrix(matrix):
+    return (ranked_pairs.get_winners_from_matrix(matrix),
+        ranked_pairs.get_ranked_partitions_from_matrix(matrix))
+
+def check(ballots, engines):
+    """
+    names of the engines that disagree with the reference on these ballots
+    """
+    expected = (reference_get_winners(ballots), reference_get_ranked_partitions(ballots))
+    failures = []
+    for name, engine in engines.items():
+        if results_from_matrix(engine(ballots)) != expected:
+            failures.append(name)
+
+    # the public ballot-based entry points, as callers use them
+    if (ranked_pairs.get_winners(ballots), ranked_pairs.get_ranked_partitions(ballots)) != expected \
+            or ranked_pairs.get_candidate_rankings(ballots) != ranked_pairs.partitions_to_rankings(expected[1]):
+        failures.append("get_*")
+    return failures
+
+def brute_force_electorates(max_options, max_voters):
+    """
+    every electorate (up to reordering voters) of at most 'max_voters' voters
+    on at most 'max_options' options, with every score from abstain to first
+    """
+    for n_options in range(1, max_options + 1):
+        possible_ballots = list(itertools.product(range(n_options), repeat=n_options))
+        for n_voters in range(1, max_voters + 1):
+            for ballots in itertools.combinations_with_replacement(possible_ballots, n_voters):
+                yield [ list(ballot) for ballot in ballots ]
+
+def random_electorates(rng, n_cases, max_options, max_voters):
+    generators = list(electorates.GENERATORS.values())
+    for _ in range(n_cases):
+        generator = rng.choice(generators)
+        abstention = rng.choice([0.0, 0.0, 0.3, 0.8])
+        yield generator(rng, rng.randint(1, max_voters), rng.randint(1, max_options), abstention)
+
+def time_engine(fn, ballots):
+    start = time.perf_counter()
+    fn(ballots)
+    return time.perf_counter() - start
+
+def check_timing(rng, max_slowdown):
+    """
+    time each engine end to end on large electorates; returns the names of
+    engines that were more than 'max_slowdown' times slower than the reference
+    """
+    failures = []
+    for n_options, n_voters in [(10, 5000), (30, 2000)]:
+        ballots = electorates.impartial_culture(rng, n_voters, n_options, 0.2)
+        reference = time_engine(reference_get_ranked_partitions, ballots)
+        print("timing {} options x {} voters: reference {:.3f}s".format(n_options, n_voters, reference))
+
+        for name, engine in ENGINES.items():
+            seconds = time_engine(lambda b: ranked_pairs.get_ranked_partitions_from_matrix(engine(b)), ballots)
+            print("  {:<12} {:.3f}s ({:.1f}x faster)".format(name, seconds, reference / seconds))
+            if seconds > reference * max_slowdown:
+                failures.append(name)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that every ranked_pairs engine agrees with the reference.")
+    parser.add_argument("--cases", type=int, default=2000, help="number of random electorates (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-options", type=int, default=8)
+    parser.add_argument("--max-voters", type=int, default=30)
+    parser.add_argument("--max-slowdown", type=float, default=1.0,
+        help="fail if an engine takes more than this many times as long as the reference (default: %(default)s)")
+    parser.add_argument("--skip-timing", action="store_true")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    electorate_sources = [
+        ("brute force", brute_force_electorates(max_options=3, max_voters=2)),
+        ("random", random_electorates(rng, args.cases, args.max_options, args.max_voters)),
+    ]
+
+    n_failures = 0
+    for source, ballot_sets in electorate_sources:
+        n_checked = 0
+        for ballots in ballot_sets:
+            engines = ENGINES
+            if n_checked % PARALLEL_EVERY == 0:
+                engines = dict(ENGINES, parallel=tally_parallel)
+
+            failures = check(ballots, engines)
+            if len(failures) > 0:
+                n_failures += 1
+                print("MISMATCH ({}) in {}: {}".format(source, ", ".join(failures), ballots))
+            n_checked += 1
+        print("checked {} {} electorates".format(n_checked, source))
+
+    if not args.skip_timing:
+        slow = check_timing(rng, args.max_slowdown)
+        for name in slow:
+            print("TOO SLOW: {}".format(name))
+        n_failures += len(slow)
+
+    if n_failures > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
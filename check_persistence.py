@@ -0,0 +1,388 @@
+"""
+Correctness and performance checks shared by every persistence backend.
+
+Runs the same checks against SQLitePersistence (in a temporary file unless
+--sqlite is given) and, with --database-url, PostgresPersistence, in both
+snapshot and incremental mode, then times writes and loads on each so the
+backends can be compared.
+
+    python3 check_persistence.py [--database-url URL] [--sqlite PATH]
+
+WARNING: this overwrites the persistence tables in the databases it's given.
+"""
+
+import argparse
+import collections
+import datetime
+import os
+import queue
+import sys
+import tempfile
+import time
+import warnings
+
+import telegram
+from telegram.ext import Dispatcher
+
+from sqlitepersistence import SQLitePersistence
+
+try:
+    import psycopg2
+    from postgrespersistence import PostgresPersistence
+except ImportError:
+    psycopg2 = None
+
+# make(**options) opens a persistence on the backend, reset() empties it
+Backend = collections.namedtuple("Backend", ["name", "make", "reset"])
+
+def sqlite_backend(path):
+    def make(**options):
+        return SQLitePersistence(path, **options)
+
+    def reset():
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    return Backend("sqlite", make, reset)
+
+def postgres_backend(database_url):
+    if psycopg2 is None:
+        sys.exit("--database-url needs psycopg2 installed")
+
+    def make(**options):
+        return PostgresPersistence(postgres_url=database_url, **options)
+
+    def reset():
+        conn = psycopg2.connect(database_url)
+        with conn, conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS telegram_persistence_entries;")
+            cur.execute("CREATE TABLE IF NOT EXISTS telegram_persistence (id SERIAL PRIMARY KEY, "
+                "data BYTEA, updated TIMESTAMP DEFAULT now());")
+            cur.execute("DELETE FROM telegram_persistence;")
+        conn.close()
+
+    return Backend("postgres", make, reset)
+
+MODES = {
+    "snapshot": {},
+    "incremental": { "incremental": True },
+}
+
+class CheckFailed(Exception):
+    pass
+
+def expect(condition, message):
+    if not condition:
+        raise CheckFailed(message)
+
+def load(persistence):
+    """
+    everything a persistence has stored, fetching all of it
+    """
+    return {
+        "user_data": { key: value for key, value in persistence.get_user_data().items() },
+        "chat_data": { key: value for key, value in persistence.get_chat_data().items() },
+        "bot_data": dict(persistence.get_bot_data()),
+        "conversations": persistence.get_conversations("conversation"),
+        "callback_data": persistence.get_callback_data(),
+    }
+
+# --- checks: each gets a backend and the options for the mode under test ---
+
+def check_round_trip(backend, options):
+    persistence = backend.make(**options)
+    load(persistence)
+    persistence.update_user_data(1, { "create_status": 1, "active_polls": { "poll" } })
+    persistence.update_chat_data(-5, { "x": [1, 2] })
+    persistence.update_bot_data({ "poll": { "question": "?", "votes": { 1: b"\x01\x00" } } })
+    persistence.update_conversation("conversation", (1, 2), "state")
+    persistence.update_callback_data(([("id", 1.0, { "a": 1 })], { "b": "id" }))
+    persistence.flush()
+
+    expect(load(backend.make(**options)) == {
+        "user_data": { 1: { "create_status": 1, "active_polls": { "poll" } } },
+        "chat_data": { -5: { "x": [1, 2] } },
+        "bot_data": { "poll": { "question": "?", "votes": { 1: b"\x01\x00" } } },
+        "conversations": { (1, 2): "state" },
+        "callback_data": ([("id", 1.0, { "a": 1 })], { "b": "id" }),
+    }, "reloaded state differs from what was stored")
+
+def check_changes(backend, options):
+    persistence = backend.make(**options)
+    load(persistence)
+    persistence.update_user_data(1, { "a": 1 })
+    persistence.update_user_data(2, { "b": 2 })
+    persistence.update_bot_data({ "kept": 1, "changed": 1, "deleted": 1 })
+    persistence.flush()
+
+    persistence = backend.make(**options)
+    load(persistence)
+    persistence.update_user_data(2, { "b": 3 })
+    persistence.update_bot_data({ "kept": 1, "changed": 2, "added": 1 })
+    persistence.flush()
+
+    stored = load(backend.make(**options))
+    expect(stored["user_data"] == { 1: { "a": 1 }, 2: { "b": 3 } }, "user_data change lost")
+    expect(stored["bot_data"] == { "kept": 1, "changed": 2, "added": 1 }, "bot_data change lost")
+
+def check_on_flush_false(backend, options):
+    """
+    without on_flush, every update is written straight away
+    """
+    persistence = backend.make(on_flush=False, **options)
+    load(persistence)
+    persistence.update_user_data(7, { "n": 1 })
+    expect(load(backend.make(**options))["user_data"] == { 7: { "n": 1 } }, "update not written immediately")
+    persistence.flush()
+
+def check_write_behind(backend, options):
+    persistence = backend.make(on_flush=False, write_behind=0.05, **options)
+    load(persistence)
+    for n in range(200):
+        persistence.update_user_data(n % 20, { "n": n })
+    persistence.flush()
+
+    expected = { user: { "n": 180 + user } for user in range(20) }
+    expect(load(backend.make(**options))["user_data"] == expected, "write-behind lost updates")
+
+def check_load_once(backend, options):
+    """
+    empty data used to count as not loaded yet, so every get_* reloaded
+    everything, replacing whatever had been loaded before
+    """
+    persistence = backend.make(**options)
+    load(persistence)
+
+    other = backend.make(**options)
+    load(other)
+    other.update_bot_data({ "written": "elsewhere" })
+    other.flush()
+
+    expect(load(persistence)["bot_data"] == {}, "loaded again")
+    persistence.flush()
+
+def check_lazy(backend, options):
+    persistence = backend.make(**options)
+    load(persistence)
+    for user in range(50):
+        persistence.update_user_data(user, { "user": user })
+    persistence.flush()
+
+    persistence = backend.make(**options)
+    user_data = persistence.get_user_data()
+    expect(len(user_data) == 50, "wrong number of users")
+    expect(len(user_data.pending) == 50, "users fetched before being used")
+    expect(user_data[17] == { "user": 17 }, "wrong user fetched")
+    expect(len(user_data.pending) == 49, "more than one user fetched")
+
+def check_lazy_dispatcher(backend, options):
+    """
+    PTB's Dispatcher lists every user and chat after each update, which
+    mustn't fetch them
+    """
+    persistence = backend.make(**options)
+    load(persistence)
+    for user in range(50):
+        persistence.update_user_data(user, { "user": user })
+    persistence.flush()
+
+    persistence = backend.make(**options)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        dispatcher = Dispatcher(telegram.Bot("123:check"), queue.Queue(), persistence=persistence)
+    user = telegram.User(17, "check", False)
+    message = telegram.Message(1, datetime.datetime.now(), telegram.Chat(17, "private"), from_user=user)
+    dispatcher.update_persistence(telegram.Update(1, message=message))
+    expect(len(dispatcher.user_data.pending) == 49, "users other than the update's fetched")
+    expect(dispatcher.user_data[17] == { "user": 17 }, "wrong user fetched")
+    persistence.flush()
+
+def check_skips_unchanged(backend, options):
+    persistence = backend.make(on_flush=False, **options)
+    load(persistence)
+    persistence.update_user_data(1, { "a": 1 })
+    written = persistence.metrics["entry_bytes_written"]
+    persistence.update_user_data(1, { "a": 1 })
+    persistence.update_user_data(2, { "b": 1 })
+    persistence.update_user_data(2, { "b": 1 })
+    expect(persistence.metrics["entry_bytes_written"] > written, "changed entry not written")
+    written = persistence.metrics["entry_bytes_written"]
+    persistence.update_user_data(1, { "a": 1 })
+    persistence.update_bot_data({})
+    expect(persistence.metrics["entry_bytes_written"] == written, "unchanged entries written again")
+    persistence.flush()
+
+class Versioned:
+    """
+    stands in for the bot's polls, which bump version on every change
+    """
+    def __init__(self):
+        self.version = 0
+        self.value = 0
+
+    def change(self):
+        self.value += 1
+        self.version += 1
+
+    def __copy__(self):
+        # as copying a poll does if another thread adds a vote meanwhile
+        raise RuntimeError("dictionary changed size during iteration")
+
+def check_live_values(backend, options):
+    """
+    PTB hands over the live object when copying it fails, which must not
+    stop later changes to it from being written
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # PTB warns that it can't copy it
+        persistence = backend.make(on_flush=False, **options)
+        load(persistence)
+        live = Versioned()
+        persistence.update_bot_data({ "poll": live })
+        live.change()
+        persistence.update_bot_data({ "poll": live })
+        live.change()
+        persistence.update_bot_data({ "poll": live })
+        persistence.flush()
+        stored = load(backend.make(**options))["bot_data"]["poll"]
+    expect(stored.value == 2, "change to a live value lost")
+
+def check_migration(backend, options):
+    """
+    switching to incremental mode carries the latest snapshot over
+    """
+    persistence = backend.make()
+    load(persistence)
+    persistence.update_user_data(1, { "a": 1 })
+    persistence.update_bot_data({ "poll": 1 })
+    persistence.flush()
+
+    migrated = backend.make(**options)
+    expect(load(migrated)["bot_data"] == { "poll": 1 }, "snapshot not carried over")
+    migrated.flush()
+    expect(load(backend.make(**options))["user_data"] == { 1: { "a": 1 } }, "migrated entries not written")
+
+def check_pruning(backend, options):
+    persistence = backend.make(on_flush=False, keep_snapshots=2, prune_interval=0.0, **options)
+    load(persistence)
+    for n in range(5):
+        persistence.update_bot_data({ "n": n })
+        if persistence.prune_thread is not None:
+            persistence.prune_thread.join()
+    expect(persistence.metrics["snapshots_pruned"] > 0, "no snapshots pruned")
+    expect(load(backend.make(**options))["bot_data"] == { "n": 4 }, "latest snapshot pruned")
+    persistence.flush()
+
+    for keep_snapshots in (0, -1):
+        try:
+            backend.make(keep_snapshots=keep_snapshots, **options)
+        except ValueError:
+            continue
+        raise CheckFailed("keep_snapshots={} accepted".format(keep_snapshots))
+
+CHECKS = {
+    "round trip": (check_round_trip, MODES),
+    "changes": (check_changes, MODES),
+    "on_flush=False": (check_on_flush_false, MODES),
+    "write-behind": (check_write_behind, MODES),
+    "load once": (check_load_once, MODES),
+    "lazy": (check_lazy, ["incremental"]),
+    "lazy with Dispatcher": (check_lazy_dispatcher, ["incremental"]),
+    "skips unchanged": (check_skips_unchanged, ["incremental"]),
+    "live values": (check_live_values, MODES),
+    "migration": (check_migration, ["incremental"]),
+    "pruning": (check_pruning, ["snapshot"]),
+}
+
+def run_checks(backend):
+    failures = []
+    for name, (check, modes) in CHECKS.items():
+        for mode in modes:
+            backend.reset()
+            try:
+                check(backend, MODES[mode])
+            except Exception as exc:
+                failures.append("{} {}/{}: {!r}".format(backend.name, mode, name, exc))
+    return failures
+
+# --- timings ---
+
+def time_writes(backend, options, n_users, n_updates):
+    """
+    updates per second with every update written straight away
+    """
+    backend.reset()
+    persistence = backend.make(on_flush=False, **options)
+    load(persistence)
+    start = time.perf_counter()
+    for n in range(n_updates):
+        persistence.update_user_data(n % n_users, { "n": n, "active_polls": set(range(n % 10)) })
+    seconds = time.perf_counter() - start
+    persistence.flush()
+    return n_updates / seconds
+
+def time_loads(backend, options, n_users):
+    """
+    seconds to start up, and then to fetch every user, with n_users stored
+    """
+    backend.reset()
+    persistence = backend.make(**options)
+    load(persistence)
+    for user in range(n_users):
+        persistence.user_data[user] = { "user": user, "active_polls": set(range(10)) }
+        persistence._mark_dirty("user_data", user)
+    persistence.flush()
+
+    start = time.perf_counter()
+    persistence = backend.make(**options)
+    user_data = persistence.get_user_data()
+    persistence.get_chat_data()
+    persistence.get_bot_data()
+    startup = time.perf_counter() - start
+    for user in range(n_users):
+        user_data[user]
+    everything = time.perf_counter() - start
+    persistence.flush()
+    return startup, everything
+
+def run_timings(backends, n_users, n_updates):
+    print("{:<10} {:<12} {:>12} {:>10} {:>14}".format("backend", "mode", "updates/s", "startup", "fetch all"))
+    for backend in backends:
+        for mode, options in MODES.items():
+            throughput = time_writes(backend, options, n_users, n_updates)
+            startup, everything = time_loads(backend, options, n_users)
+            print("{:<10} {:<12} {:>12.0f} {:>9.3f}s {:>13.3f}s".format(
+                backend.name, mode, throughput, startup, everything))
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time every persistence backend.")
+    parser.add_argument("--sqlite", help="SQLite file to use (default: a temporary one)")
+    parser.add_argument("--database-url",
+        help="also check PostgresPersistence here; WARNING: its persistence tables are overwritten")
+    parser.add_argument("--users", type=int, default=5000, help="users stored for the load timings")
+    parser.add_argument("--updates", type=int, default=500, help="updates written for the write timings")
+    parser.add_argument("--skip-timing", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        backends = [ sqlite_backend(args.sqlite or os.path.join(directory, "persistence.sqlite3")) ]
+        if args.database_url is not None:
+            backends.append(postgres_backend(args.database_url))
+
+        failures = []
+        for backend in backends:
+            backend_failures = run_checks(backend)
+            print("checked {}: {} failures".format(backend.name, len(backend_failures)))
+            failures += backend_failures
+        for failure in failures:
+            print("FAILED {}".format(failure))
+
+        if not args.skip_timing:
+            run_timings(backends, args.users, args.updates)
+
+    if len(failures) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Seeded generators of synthetic electorates, for benchmarking and checking
+the ranked_pairs engine.
+
+Every generator takes a random.Random, the number of voters and options and
+the probability that a voter abstains on any given option, and returns
+ballots in the form ranked_pairs expects (one row of scores per voter, the
+higher the better, abstentions scoring 0), just like Vote.finalize makes.
+"""
+
+import ranked_pairs
+
+def abstain(rng, rankings, abstention):
+    return [ 0 if rng.random() < abstention else rank for rank in rankings ]
+
+def impartial_culture(rng, n_voters, n_options, abstention=0.0):
+    """
+    every voter ranks the options in a uniformly random order
+    """
+    ballots = []
+    for _ in range(n_voters):
+        order = list(range(n_options))
+        rng.shuffle(order)
+        rankings = [ None ] * n_options
+        for rank, option_idx in enumerate(order, start=1):
+            rankings[option_idx] = rank
+        ballots.append(ranked_pairs.ranks_to_scores(abstain(rng, rankings, abstention)))
+    return ballots
+
+def single_peaked(rng, n_voters, n_options, abstention=0.0):
+    """
+    options lie on a line and every voter's preferences fall off on either
+    side of their favorite one; orders are drawn uniformly among all
+    single-peaked orders by peeling the least favorite option off of one
+    end of the line at a time
+    """
+    ballots = []
+    for _ in range(n_voters):
+        left, right = 0, n_options - 1
+        rankings = [ None ] * n_options
+        for rank in range(n_options, 0, -1):
+            if rng.random() < 0.5:
+                rankings[left] = rank
+                left += 1
+            else:
+                rankings[right] = rank
+                right -= 1
+        ballots.append(ranked_pairs.ranks_to_scores(abstain(rng, rankings, abstention)))
+    return ballots
+
+def heavy_tie(rng, n_voters, n_options, abstention=0.0):
+    """
+    every voter sorts the options into just a few tiers, so most pairs are
+    tied on most ballots and many pairs are tied overall
+    """
+    n_tiers = min(3, n_options)
+    ballots = []
+    for _ in range(n_voters):
+        rankings = [ rng.randint(1, n_tiers) for _ in range(n_options) ]
+        ballots.append(ranked_pairs.ranks_to_scores(abstain(rng, rankings, abstention)))
+    return ballots
+
+GENERATORS = {
+    "impartial": impartial_culture,
+    "single-peaked": single_peaked,
+    "heavy-tie": heavy_tie,
+}
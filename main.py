@@ -1,16 +1,24 @@
 import telegram
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, \
-    InlineQueryHandler, CallbackQueryHandler
-from telegram.error import TelegramError
+    InlineQueryHandler, CallbackQueryHandler, ChosenInlineResultHandler
+from telegram.error import TelegramError, BadRequest, RetryAfter, NetworkError, Unauthorized
 from postgrespersistence import PostgresPersistence
+from sqlitepersistence import SQLitePersistence
+from storagepersistence import entry_keys
 
 import ranked_pairs
 
 import logging
 
+import array
+import base64
+import collections
 import datetime
+import hashlib
+import heapq
 import uuid
 import sys
+import threading
 import os
 import time
 from enum import Enum
@@ -55,51 +63,224 @@ class CallbackDataType(Enum):
     CHANGE_OF_RANK = 8
     # TODO delete poll?
 
-# TODO telegram probably has a better way of passing data in a way that's under 64 bytes...
-def encode_refresh(poll_id):
-    return "0:{}".format(poll_id)
-def encode_refresh_admin(poll_id):
-    return "7:{}".format(poll_id)
-def encode_vote_start(poll_id):
-    return "1:{}".format(poll_id)
-def encode_option(poll_id, opt_idx):
-    return "2:{}:{}".format(poll_id, opt_idx)
-def encode_rank(poll_id, rank):
-    return "3:{}:{}".format(poll_id, rank)
-def encode_submit(poll_id):
-    return "4:{}".format(poll_id)
-def encode_retract(poll_id):
-    return "5:{}".format(poll_id)
-def encode_close(poll_id):
-    return "6:{}".format(poll_id)
-def encode_rank_change(poll_id):
-    return "8:{}".format(poll_id)
+# callback data is "<type><poll handle>[<argument>]", e.g. "2q6GcNZ0x3" for
+# option 3; buttons sent before handles existed hold "<type>:<poll id>[:<argument>]"
+def encode_refresh(handle):
+    return "0" + handle
+def encode_refresh_admin(handle):
+    return "7" + handle
+def encode_vote_start(handle):
+    return "1" + handle
+def encode_option(handle, opt_idx):
+    return "2{}{}".format(handle, opt_idx)
+def encode_rank(handle, rank):
+    return "3{}{}".format(handle, rank)
+def encode_submit(handle):
+    return "4" + handle
+def encode_retract(handle):
+    return "5" + handle
+def encode_close(handle):
+    return "6" + handle
+def encode_rank_change(handle):
+    return "8" + handle
+
+# type character -> (type, whether the data ends in an integer argument)
+CALLBACK_TYPES = { str(data_type.value): (data_type,
+    data_type in (CallbackDataType.SELECTING_OPTION, CallbackDataType.SELECTING_RANK))
+    for data_type in CallbackDataType }
 
 def decode_callback(s):
-    if s[0] == "0":
-        return CallbackDataType.REFRESH, s[2:]
-    if s[0] == "1":
-        return CallbackDataType.STARTING_VOTE, s[2:]
-    elif s[0] == "2":
-        sep = s.rfind(":")
-        return CallbackDataType.SELECTING_OPTION, s[2:sep], int(s[sep+1:])
-    elif s[0] == "3":
-        sep = s.rfind(":")
-        return CallbackDataType.SELECTING_RANK, s[2:sep], int(s[sep+1:])
-    elif s[0] == "4":
-        return CallbackDataType.SUBMITTING_VOTE, s[2:]
-    elif s[0] == "5":
-        return CallbackDataType.RETRACTING_VOTE, s[2:]
-    elif s[0] == "6":
-        return CallbackDataType.CLOSING_POLL, s[2:]
-    elif s[0] == "7":
-        return CallbackDataType.REFRESH_ADMIN, s[2:]
-    elif s[0] == "8":
-        return CallbackDataType.CHANGE_OF_RANK, s[2:]
-    else:
+    """
+    (type, poll handle or id[, argument])
+    """
+    try:
+        data_type, takes_argument = CALLBACK_TYPES[s[:1]]
+    except KeyError:
         raise InvalidInput("unknown callback: {}".format(s))
 
+    if s[1:2] != ":":
+        if takes_argument:
+            return data_type, s[1:HANDLE_LENGTH+1], int(s[HANDLE_LENGTH+1:])
+        return data_type, s[1:]
+
+    poll_id, _, argument = s[2:].partition(":")
+    if takes_argument:
+        return data_type, poll_id, int(argument)
+    return data_type, poll_id
+
+# a poll's handle is the start of its id in URL-safe base64: 48 random bits
+HANDLE_LENGTH = 8
+
+def poll_handle(poll_id):
+    return base64.urlsafe_b64encode(uuid.UUID(poll_id).bytes)[:HANDLE_LENGTH].decode()
+
+class PollIndex:
+    """
+    poll handle -> poll id, for every poll in bot_data; built from bot_data's
+    keys alone, so no poll has to be loaded to find one by its handle
+    """
+    def __init__(self):
+        self.ids = {}
+        self.n_indexed = 0
+
+    def rebuild(self, bot_data):
+        self.ids = {}
+        for poll_id in entry_keys(bot_data):
+            try:
+                self.ids[poll_handle(poll_id)] = poll_id
+            except ValueError:
+                pass # not a poll
+        self.n_indexed = len(bot_data)
+
+    def add(self, poll):
+        self.ids[poll.handle] = poll.id
+        self.n_indexed += 1
+
+    def lookup(self, bot_data, handle):
+        poll_id = self.ids.get(handle)
+        if poll_id is None and self.n_indexed != len(bot_data):
+            # polls were loaded, or created by another process, since the last rebuild
+            self.rebuild(bot_data)
+            poll_id = self.ids.get(handle)
+        return poll_id
+
+    def find(self, bot_data, key):
+        """
+        the poll with this handle, or with this id from old callback data
+        """
+        if len(key) == HANDLE_LENGTH:
+            key = self.lookup(bot_data, key)
+        return bot_data.get(key)
+
+poll_index = PollIndex()
+
+# keyboards only depend on their poll, so they're built once and shared by
+# every message and ballot showing it; see cached_keyboard
+EMPTY_KEYBOARD = telegram.InlineKeyboardMarkup([[]])
+KEYBOARD_CACHE_SIZE = 1024
+keyboard_cache = collections.OrderedDict() # (poll id, kind) -> InlineKeyboardMarkup, least recently used first
+keyboard_cache_lock = threading.Lock()
+# id() -> digest of its JSON, for every keyboard in keyboard_cache, which
+# keeps them alive so their ids can't be reused
+keyboard_digests = {}
+
+def cached_keyboard(poll, kind, build):
+    """
+    build(poll), or the same keyboard as last time for this poll and kind
+    """
+    key = (poll.id, kind)
+    with keyboard_cache_lock:
+        keyboard = keyboard_cache.get(key)
+        if keyboard is not None:
+            keyboard_cache.move_to_end(key)
+            return keyboard
+    keyboard = build(poll)
+    digest = keyboard_digest(keyboard)
+    with keyboard_cache_lock:
+        existing = keyboard_cache.get(key)
+        if existing is not None:
+            # another thread built it meanwhile; only the cached one may have a digest
+            keyboard_cache.move_to_end(key)
+            return existing
+        keyboard_cache[key] = keyboard
+        keyboard_digests[id(keyboard)] = digest
+        if len(keyboard_cache) > KEYBOARD_CACHE_SIZE:
+            _, evicted = keyboard_cache.popitem(last=False)
+            del keyboard_digests[id(evicted)]
+    return keyboard
+
+def keyboard_digest(keyboard):
+    """
+    identifies what a keyboard shows, without serializing cached ones again
+    """
+    digest = keyboard_digests.get(id(keyboard))
+    if digest is None:
+        digest = hashlib.blake2b(keyboard.to_json().encode(), digest_size=16).digest()
+    return digest
+
+class MessageEdits:
+    """
+    remembers a digest of what each recently sent or edited message shows,
+    so edits that wouldn't change it are skipped instead of sent and
+    rejected by Telegram as "message is not modified"
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.digests = collections.OrderedDict() # message -> digest, least recently used first
+        self.lock = threading.Lock()
+        self.metrics = { "edits_sent": 0, "edits_skipped": 0 }
+
+    @staticmethod
+    def digest(content, reply_markup):
+        return hashlib.blake2b(content.encode(), digest_size=16, key=keyboard_digest(reply_markup)).digest()
+
+    def record(self, message, digest, sent=False):
+        """
+        'sent' counts an edit towards metrics
+        """
+        with self.lock:
+            if sent:
+                self.metrics["edits_sent"] += 1
+            self.digests[message] = digest
+            self.digests.move_to_end(message)
+            if len(self.digests) > self.size:
+                self.digests.popitem(last=False)
+
+    def sent(self, message, content, reply_markup):
+        self.record(message, self.digest(content, reply_markup))
+
+    def edit(self, message, content, reply_markup, send):
+        """
+        call send() to make 'message' show 'content' and 'reply_markup',
+        unless it already does; content is everything about the text that
+        matters, which send() may add a timestamp to. Returns whether an edit
+        was sent
+        """
+        digest = self.digest(content, reply_markup)
+        with self.lock:
+            if self.digests.get(message) == digest:
+                self.metrics["edits_skipped"] += 1
+                return False
+        try:
+            send()
+        except BadRequest as e:
+            if "not modified" not in e.message:
+                raise
+        self.record(message, digest, sent=True)
+        return True
+
+message_edits = MessageEdits()
+
+# seconds between logging message_edits.metrics
+METRICS_INTERVAL = 600.0
+
+def log_metrics():
+    with message_edits.lock:
+        metrics = dict(message_edits.metrics)
+    logging.getLogger(__name__).info("Message edits: %(edits_sent)d sent, %(edits_skipped)d skipped as unchanged",
+        metrics)
+    timers.schedule("metrics", METRICS_INTERVAL, log_metrics)
+
+# ballots are stored as arrays of unsigned shorts rather than lists of ints
+RANK_TYPECODE = "H"
+
+def rank_array(ranks=()):
+    return array.array(RANK_TYPECODE, ranks)
+
+def rank_array_from_bytes(data):
+    ranks = rank_array()
+    ranks.frombytes(data)
+    return ranks
+
+# guards every Poll.messages and results_pusher's pending and last_edit,
+# which the Timers thread changes as well as the dispatcher's
+messages_lock = threading.Lock()
+
 class Poll:
+    __slots__ = ("question", "live_results", "owner", "ongoing", "options", "votes",
+        "option_ranks", "pairwise", "n_counted", "n_drafts", "id", "version", "rendered",
+        "results_dirty", "messages", "handle", "tally_lock")
+
     def __init__(self, question, options, live_results, owner):
         self.question = question
         self.live_results = live_results
@@ -109,32 +290,108 @@ class Poll:
         self.votes = {}
 
         self.option_ranks = [1] * len(options)
+        # set while live results are out of date, see update_winners_if_live
+        self.results_dirty = False
+
+        # running pairwise tally of all COUNTED ballots, see update_tally;
+        # tally_lock keeps an election on the Timers thread from reading it
+        # halfway through a change
+        self.tally_lock = threading.Lock()
+        self.pairwise = ranked_pairs.empty_matrix(len(options))
+        self.n_counted = 0
+        self.n_drafts = 0 # votes IN_PROGRESS, see status_changed
+
+        self.new_id()
+
+        # bumped on every change to the poll or its votes, so persistence can
+        # tell whether it changed without comparing it
+        self.version = 0
+        self.rendered = None # (version, HTML body) cached by get_html_repr
+
+        # messages showing this poll, which ResultsPusher keeps up to date:
+        # (chat_id, message_id) or inline_message_id -> whether it's the owner's
+        self.messages = {}
 
+    def new_id(self):
         self.id = str(uuid.uuid4()) # generate random id for each poll that's unreasonably hard to guess
+        self.handle = poll_handle(self.id) # short form for callback data, see PollIndex
+
+    def __getstate__(self):
+        """
+        a flat tuple instead of a dict of attribute names
+        """
+        return (self.id, self.question, self.options, self.live_results, self.owner, self.ongoing,
+            self.option_ranks, self.pairwise, self.n_counted,
+            # tuple() copies the votes without letting another thread add
+            # one halfway through, as it would between __getstate__ calls
+            [ vote.__getstate__() for vote in tuple(self.votes.values()) ], self.version,
+            self.get_messages())
+
+    def __setstate__(self, state):
+        self.tally_lock = threading.Lock()
+        if isinstance(state, dict):
+            # persisted before Poll had __slots__, as its attribute dict
+            for name, value in state.items():
+                setattr(self, name, value)
+            self.version = 0
+            self.rendered = None
+            if "pairwise" not in state:
+                # polls persisted before the running tally existed
+                self.rebuild_tally()
+            self.count_drafts()
+            self.results_dirty = self.live_results and self.ongoing
+            self.messages = {}
+            self.handle = poll_handle(self.id)
+            return
+
+        if len(state) == 10:
+            state += (0,) # persisted before polls had versions
+        if len(state) == 11:
+            state += ({},) # persisted before polls tracked their messages
+        (self.id, self.question, self.options, self.live_results, self.owner, self.ongoing,
+            self.option_ranks, self.pairwise, self.n_counted, vote_states, self.version,
+            self.messages) = state
+        self.votes = {}
+        for vote_state in vote_states:
+            vote = Vote.__new__(Vote)
+            vote.__setstate__(vote_state)
+            self.votes[vote.user] = vote
+        self.rendered = None
+        self.handle = poll_handle(self.id)
+        self.count_drafts()
+        # whether they were up to date when stored isn't kept
+        self.results_dirty = self.live_results and self.ongoing
 
     def get_public_buttons(self):
         if not self.ongoing:
-            return telegram.InlineKeyboardMarkup([[]])
+            return EMPTY_KEYBOARD
+        return cached_keyboard(self, "public", Poll.build_public_buttons)
 
-        return telegram.InlineKeyboardMarkup([
-            [telegram.InlineKeyboardButton(text="Vote",
-                callback_data=encode_vote_start(self.id))],
-            [telegram.InlineKeyboardButton(text="Refresh Results", callback_data=encode_refresh(self.id))]
-        ])
     def get_admin_buttons(self):
         if not self.ongoing:
-            return telegram.InlineKeyboardMarkup([[]])
+            return EMPTY_KEYBOARD
+        return cached_keyboard(self, "admin", Poll.build_admin_buttons)
 
+    def build_public_buttons(self):
+        return telegram.InlineKeyboardMarkup([
+            [telegram.InlineKeyboardButton(text="Vote",
+                callback_data=encode_vote_start(self.handle))],
+            [telegram.InlineKeyboardButton(text="Refresh Results", callback_data=encode_refresh(self.handle))]
+        ])
+    def build_admin_buttons(self):
         return telegram.InlineKeyboardMarkup([ # TODO support poll title in inline query and pass it here
-            [telegram.InlineKeyboardButton(text="Close Poll", callback_data=encode_close(self.id))],
-            [telegram.InlineKeyboardButton(text="Refresh Results", callback_data=encode_refresh_admin(self.id))],
+            [telegram.InlineKeyboardButton(text="Close Poll", callback_data=encode_close(self.handle))],
+            [telegram.InlineKeyboardButton(text="Refresh Results", callback_data=encode_refresh_admin(self.handle))],
             [telegram.InlineKeyboardButton(text="Share Poll", switch_inline_query=""),
-            telegram.InlineKeyboardButton(text="Vote", callback_data=encode_vote_start(self.id))]
+            telegram.InlineKeyboardButton(text="Vote", callback_data=encode_vote_start(self.handle))]
         ])
 
     def get_inline_result(self):
         """
         Content that users will send to others to allow them to cast votes
+
+        Built for every answer so its timestamp is current; the body and
+        buttons are cached until the poll changes
         """
         return telegram.InlineQueryResultDocument(id=self.id,
             title=self.question,
@@ -145,7 +402,26 @@ class Poll:
     def get_html_repr(self):
         """
         Get representation of a poll: question, options, result type, whether poll is ongoing
+
+        Only the timestamp is rendered every time; the rest is cached until the poll changes
+        """
+        last_update_str = datetime.datetime.strftime(datetime.datetime.now(), '%c')
+
+        return self.get_html_body() + \
+            "\n\nLast updated: {}".format(last_update_str) + \
+            '\nP.S. you have to have <a href="{}">DM\'d me</a> before voting'.format(DM_URL)
+
+    def get_html_body(self):
         """
+        get_html_repr without its timestamp and footer
+        """
+        self.update_results()
+        rendered = self.rendered
+        if rendered is None or rendered[0] != self.version:
+            rendered = self.rendered = (self.version, self.render_body())
+        return rendered[1]
+
+    def render_body(self):
         poll_type = "live ranked-pairs poll" if self.live_results else "ranked-pairs poll with results at end"
 
         if self.live_results or not self.ongoing:
@@ -159,51 +435,144 @@ class Poll:
             option_lines_str = '\n'.join( "• " + opt for opt in self.options)
 
         poll_status = "ongoing poll" if self.ongoing else "closed poll"
-        last_update_str = datetime.datetime.strftime(datetime.datetime.now(), '%c')
 
-        n_votes = sum(vote.status == VoteStatus.COUNTED for vote in self.votes.values())
-        n_drafts = sum(vote.status == VoteStatus.IN_PROGRESS for vote in self.votes.values())
+        # every COUNTED ballot is in the tally
+        n_votes = self.n_counted
 
         return ("<b>{}</b>\n" + \
             "<i>{}</i>\n\n" + \
             option_lines_str + \
             "\n\n<i>{}</i>" + \
-            "\n{} votes submitted, {} ballot drafts" + \
-            "\n\nLast updated: {}" + \
-            '\nP.S. you have to have <a href="{}">DM\'d me</a> before voting') \
-                .format(self.question, poll_type, poll_status, n_votes, n_drafts, last_update_str, DM_URL)
+            "\n{} votes submitted, {} ballot drafts") \
+                .format(self.question, poll_type, poll_status, n_votes, self.n_drafts)
 
     def send_to_owner(self, bot):
-        bot.send_message(chat_id=self.owner,
+        reply_markup = self.get_admin_buttons()
+        message = bot.send_message(chat_id=self.owner,
             text=self.get_html_repr(), parse_mode=telegram.ParseMode.HTML,
-            reply_markup=self.get_admin_buttons())
+            reply_markup=reply_markup)
+        self.track_message((message.chat_id, message.message_id), True)
+        message_edits.sent((message.chat_id, message.message_id), self.get_html_body(), reply_markup)
+        return message
+
+    def track_message(self, message, admin):
+        """
+        keep 'message' up to date as this poll changes, see ResultsPusher;
+        only the latest MAX_TRACKED_MESSAGES are kept
+        """
+        with messages_lock:
+            if message in self.messages:
+                return
+            self.messages[message] = admin
+            while len(self.messages) > MAX_TRACKED_MESSAGES:
+                del self.messages[next(iter(self.messages))]
+            self.touch()
+
+    def forget_message(self, message):
+        with messages_lock:
+            if self.messages.pop(message, None) is not None:
+                self.touch()
+
+    def get_messages(self):
+        """
+        a copy of messages, safe to iterate while the Timers thread changes it
+        """
+        with messages_lock:
+            return dict(self.messages)
+
+    def touch(self):
+        """
+        record a change to this poll, see version
+        """
+        self.version += 1
+
+    def status_changed(self, old_status, new_status):
+        """
+        keep n_drafts up to date as a vote goes from old_status to new_status,
+        either of which is None for a vote being added or removed
+        """
+        if old_status == VoteStatus.IN_PROGRESS:
+            self.n_drafts -= 1
+        if new_status == VoteStatus.IN_PROGRESS:
+            self.n_drafts += 1
+        self.touch()
+
+    def count_drafts(self):
+        self.n_drafts = sum(vote.status == VoteStatus.IN_PROGRESS for vote in self.votes.values())
 
     def add_vote(self, user):
         if user not in self.votes:
-            self.votes[user] = Vote(user, self)
+            vote = self.votes[user] = Vote(user, len(self.options))
+            self.status_changed(None, vote.status)
         return self.votes[user]
 
     def remove_vote(self, user):
         if user in self.votes:
-            del self.votes[user]
+            vote = self.votes.pop(user)
+            self.status_changed(vote.status, None)
+            if vote.status == VoteStatus.COUNTED:
+                self.update_tally(vote.mapped_option_rankings, None)
         self.update_winners_if_live()
 
-    def call_election(self):
-        ballots = [
+    def update_tally(self, old_ballot, new_ballot):
+        """
+        replace one counted ballot with another in the running pairwise tally,
+        either of which may be None to only add or only retract a ballot
+        """
+        with self.tally_lock:
+            if old_ballot is not None:
+                ranked_pairs.add_ballot(self.pairwise, old_ballot, -1)
+                self.n_counted -= 1
+            if new_ballot is not None:
+                ranked_pairs.add_ballot(self.pairwise, new_ballot)
+                self.n_counted += 1
+        self.touch()
+
+    def get_weighted_ballots(self):
+        """
+        all COUNTED ballots, with identical ballots collapsed into
+        (ballot, count) pairs
+        """
+        return ranked_pairs.collapse_ballots(
             vote.mapped_option_rankings for vote in self.votes.values()
-            if vote.status == VoteStatus.COUNTED
-        ]
-        if len(ballots) > 0:
-            self.option_ranks = ranked_pairs.get_candidate_rankings(ballots)
-        else:
-            self.option_ranks = [1] * len(self.options)
+            if vote.status == VoteStatus.COUNTED)
+
+    def rebuild_tally(self):
+        weighted_ballots = self.get_weighted_ballots()
+        with self.tally_lock:
+            if len(weighted_ballots) > 0:
+                self.pairwise = ranked_pairs.tally_weighted(weighted_ballots)
+            else:
+                self.pairwise = ranked_pairs.empty_matrix(len(self.options))
+            self.n_counted = sum(count for _, count in weighted_ballots)
+        self.touch()
+
+    def call_election(self):
+        # cleared first, so a change made while the election runs marks it out of date again
+        self.results_dirty = False
+        with self.tally_lock:
+            if self.n_counted > 0:
+                self.option_ranks = ranked_pairs.get_candidate_rankings_from_matrix(self.pairwise)
+            else:
+                self.option_ranks = [1] * len(self.options)
+        self.touch()
 
     def update_winners_if_live(self):
+        """
+        mark live results as out of date; they are recomputed only when shown
+        (see update_results) or by the timer schedule_election starts, so a
+        burst of ballots runs a single election
+        """
         if self.live_results:
+            self.results_dirty = True
+
+    def update_results(self):
+        if self.results_dirty:
             self.call_election()
 
     def close(self):
         self.ongoing = False
+        self.touch()
         self.call_election()
 
 class VoteStatus(Enum):
@@ -213,24 +582,73 @@ class VoteStatus(Enum):
     RETRACTED_LATE = 4
 
 class Vote:
-    def __init__(self, user, poll):
-        self.poll = poll
+    """
+    one user's ballot in a poll; methods that need the poll take it as an
+    argument rather than each vote holding a reference to it
+    """
+    __slots__ = ("user", "n_options", "option_rankings", "mapped_option_rankings",
+        "ballot_message", "status", "current_rank", "version")
+
+    def __init__(self, user, n_options):
         self.user = user
-        self.n_options = len(poll.options)
-        self.option_rankings = [0] * self.n_options
+        self.n_options = n_options
+        self.option_rankings = rank_array([0] * self.n_options)
+        self.mapped_option_rankings = None # set by finalize
 
-        self.ballot_message = None
+        self.ballot_message = None # (chat_id, message_id) of the ballot sent to the user
         self.status = VoteStatus.IN_PROGRESS
 
         self.current_rank = 1
 
-    def retract_vote(self):
-        if self.poll.ongoing:
-            self.poll.remove_vote(self.user)
+        self.version = 0 # see touch
+
+    def __getstate__(self):
+        mapped = None if self.mapped_option_rankings is None else self.mapped_option_rankings.tobytes()
+        return (self.user, self.status.value, self.current_rank, self.ballot_message,
+            self.option_rankings.tobytes(), mapped, self.version)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # persisted before Vote had __slots__, as its attribute dict
+            self.user = state["user"]
+            self.status = state["status"]
+            self.current_rank = state["current_rank"]
+            message = state["ballot_message"]
+            self.ballot_message = None if message is None else (message.chat_id, message.message_id)
+            self.option_rankings = rank_array(state["option_rankings"])
+            mapped = state.get("mapped_option_rankings")
+            self.mapped_option_rankings = None if mapped is None else rank_array(mapped)
+            self.version = 0
+        else:
+            if len(state) == 6:
+                state += (0,) # persisted before votes had versions
+            self.user, status, self.current_rank, self.ballot_message, rankings, mapped, self.version = state
+            self.status = VoteStatus(status)
+            self.option_rankings = rank_array_from_bytes(rankings)
+            self.mapped_option_rankings = None if mapped is None else rank_array_from_bytes(mapped)
+        self.n_options = len(self.option_rankings)
+
+    def touch(self, poll):
+        """
+        record a change to this vote, which is also a change to its poll
+        """
+        self.version += 1
+        poll.touch()
+
+    def set_status(self, poll, status):
+        old_status, self.status = self.status, status
+        poll.status_changed(old_status, status)
+        self.touch(poll)
+
+    def retract_vote(self, poll, bot):
+        if poll.ongoing:
+            poll.remove_vote(self.user)
             if self.ballot_message:
-                self.ballot_message.delete()
+                bot.delete_message(*self.ballot_message)
         else:
-            self.status = VoteStatus.RETRACTED_LATE
+            if self.status == VoteStatus.COUNTED:
+                poll.update_tally(self.mapped_option_rankings, None)
+            self.set_status(poll, VoteStatus.RETRACTED_LATE)
 
     @classmethod
     def rank_to_str(cls, rank):
@@ -248,9 +666,9 @@ class Vote:
             else:
                 return "{}th".format(rank)
 
-    def get_ballot_html(self):
+    def get_ballot_html(self, poll):
         ballot_draft = "\n".join( \
-            self.poll.options[i] + " - " + Vote.rank_to_str(self.option_rankings[i]) \
+            poll.options[i] + " - " + Vote.rank_to_str(self.option_rankings[i]) \
             for i in range(self.n_options))
         worst_rank = Vote.rank_to_str(self.n_options)
 
@@ -279,9 +697,9 @@ class Vote:
             "(1st = good, {} = bad, ABSTAIN = even worse than {}.) " + \
             "\n\n<b>{}</b>\n{}" + \
             "\n\n<i>Ballot status: {}</i>\n{}") \
-            .format(self.n_options, worst_rank, worst_rank, self.poll.question, ballot_draft, status, instructions)
+            .format(self.n_options, worst_rank, worst_rank, poll.question, ballot_draft, status, instructions)
 
-    def tap_option(self, option):
+    def tap_option(self, poll, option):
         if option < 0 or option >= self.n_options:
             raise InvalidInput("invalid option!")
         else:
@@ -289,79 +707,394 @@ class Vote:
 
             if self.current_rank > 0:
                 self.current_rank = (self.current_rank + 1) % (self.n_options + 1)
+            self.touch(poll)
 
-    def tap_rank(self, rank):
+    def tap_rank(self, poll, rank):
         if rank < 0 or rank > self.n_options:
             raise InvalidInput("invalid rank!")
 
         self.current_rank = rank
+        self.touch(poll)
 
-    def clear_current_ranking(self):
+    def clear_current_ranking(self, poll):
         self.current_rank = None
+        self.touch(poll)
 
     def __set_ranking(self, option, rank):
         self.option_rankings[option] = rank
 
-    def get_button_data(self):
+    def get_button_data(self, poll):
         if self.status == VoteStatus.COUNTED:
-            return telegram.InlineKeyboardMarkup([[
-                telegram.InlineKeyboardButton(text="Retract Vote", callback_data=encode_retract(self.poll.id))
-            ]])
+            return cached_keyboard(poll, "counted", Vote.build_counted_buttons)
         elif self.status == VoteStatus.IN_PROGRESS:
             if self.current_rank is None:
-                button_lst = [ \
-                    telegram.InlineKeyboardButton(text=Vote.rank_to_str(i), \
-                    callback_data=encode_rank(self.poll.id, i)) \
-                    for i in range(self.n_options + 1) ]
+                return cached_keyboard(poll, "ranks", Vote.build_rank_buttons)
             else:
-                rankings = list(map(Vote.rank_to_str, self.option_rankings))
-                button_lst = [
-                    telegram.InlineKeyboardButton(text=self.poll.options[i], \
-                    callback_data=encode_option(self.poll.id, i)) \
-                    for i in range(self.n_options) ]
-
-                button_lst.append(
-                    telegram.InlineKeyboardButton(text="Change Rank",
-                    callback_data=encode_rank_change(self.poll.id)))
-
-            return telegram.InlineKeyboardMarkup([ [btn] for btn in button_lst ] + [[
-                telegram.InlineKeyboardButton(text="Cancel Vote", callback_data=encode_retract(self.poll.id)),
-                telegram.InlineKeyboardButton(text="Submit Vote", callback_data=encode_submit(self.poll.id))
-            ]]) # always allow user to submit, cancel vote
+                return cached_keyboard(poll, "options", Vote.build_option_buttons)
         else:
-            return telegram.InlineKeyboardMarkup([[]])
-
-    def send_ballot(self, bot):
+            return EMPTY_KEYBOARD
+
+    @staticmethod
+    def build_counted_buttons(poll):
+        return telegram.InlineKeyboardMarkup([[
+            telegram.InlineKeyboardButton(text="Retract Vote", callback_data=encode_retract(poll.handle))
+        ]])
+
+    @staticmethod
+    def build_rank_buttons(poll):
+        return Vote.build_draft_buttons(poll, [
+            telegram.InlineKeyboardButton(text=Vote.rank_to_str(i), \
+            callback_data=encode_rank(poll.handle, i)) \
+            for i in range(len(poll.options) + 1) ])
+
+    @staticmethod
+    def build_option_buttons(poll):
+        button_lst = [
+            telegram.InlineKeyboardButton(text=poll.options[i], \
+            callback_data=encode_option(poll.handle, i)) \
+            for i in range(len(poll.options)) ]
+
+        button_lst.append(
+            telegram.InlineKeyboardButton(text="Change Rank",
+            callback_data=encode_rank_change(poll.handle)))
+        return Vote.build_draft_buttons(poll, button_lst)
+
+    @staticmethod
+    def build_draft_buttons(poll, button_lst):
+        return telegram.InlineKeyboardMarkup([ [btn] for btn in button_lst ] + [[
+            telegram.InlineKeyboardButton(text="Cancel Vote", callback_data=encode_retract(poll.handle)),
+            telegram.InlineKeyboardButton(text="Submit Vote", callback_data=encode_submit(poll.handle))
+        ]]) # always allow user to submit, cancel vote
+
+    def send_ballot(self, poll, bot):
         if self.ballot_message is not None:
-            self.ballot_message.delete() # only one ballot at a time
+            bot.delete_message(*self.ballot_message) # only one ballot at a time
 
-        self.ballot_message = bot.send_message(chat_id=self.user,
-            text=self.get_ballot_html(),
+        text = self.get_ballot_html(poll)
+        reply_markup = self.get_button_data(poll)
+        message = bot.send_message(chat_id=self.user,
+            text=text,
             parse_mode=telegram.ParseMode.HTML,
-            reply_markup=self.get_button_data())
+            reply_markup=reply_markup)
+        self.ballot_message = (message.chat_id, message.message_id)
+        message_edits.sent(self.ballot_message, text, reply_markup)
+        self.touch(poll)
 
-    def update_ballot(self):
+    def update_ballot(self, poll, bot):
         if self.ballot_message is not None:
+            chat_id, message_id = self.ballot_message
+            text = self.get_ballot_html(poll)
+            reply_markup = self.get_button_data(poll)
             try:
-                self.ballot_message.edit_text( \
-                    text=self.get_ballot_html(), parse_mode=telegram.ParseMode.HTML,
-                    reply_markup=self.get_button_data())
+                message_edits.edit(self.ballot_message, text, reply_markup,
+                    lambda: bot.edit_message_text(chat_id=chat_id, message_id=message_id,
+                    text=text, parse_mode=telegram.ParseMode.HTML, reply_markup=reply_markup))
             except TelegramError:
-                pass # ignore error if message was not modified
+                pass
+
+    def finalize(self, poll):
+        old_ballot = self.mapped_option_rankings if self.status == VoteStatus.COUNTED else None
 
-    def finalize(self):
-        if self.poll.ongoing:
-            self.status = VoteStatus.COUNTED
+        if poll.ongoing:
+            self.set_status(poll, VoteStatus.COUNTED)
         else:
-            self.status = VoteStatus.LATE
+            self.set_status(poll, VoteStatus.LATE)
 
         # map inputs to form expected by ranked pairs implementation
-        self.mapped_option_rankings = [ \
-            self.n_options - rank if rank > 0 else 0 \
-            for rank in self.option_rankings \
-        ]
+        self.mapped_option_rankings = rank_array(ranked_pairs.ranks_to_scores(self.option_rankings))
+        self.touch(poll)
+
+        poll.update_tally(old_ballot,
+            self.mapped_option_rankings if self.status == VoteStatus.COUNTED else None)
+        poll.update_winners_if_live()
+
+def get_user_polls(context):
+    """
+    the polls in this user's active_polls, which holds poll ids
+    """
+    poll_ids = context.user_data.setdefault("active_polls", set())
+    polls = []
+    for entry in list(poll_ids):
+        if isinstance(entry, Poll):
+            # persisted when active_polls held the polls themselves
+            poll_ids.discard(entry)
+            poll_ids.add(entry.id)
+            entry = entry.id
+        poll = context.bot_data.get(entry)
+        if poll is not None:
+            polls.append(poll)
+    return polls
+
+class Timers:
+    """
+    runs callbacks once each, after a delay, on a background thread. Unlike
+    JobQueue jobs, whose every run makes PTB copy and save every user's and
+    chat's data, these leave persistence alone; whatever they change is
+    saved along with the next update
+    """
+    def __init__(self):
+        self.due = [] # heap of (when, sequence number, name)
+        self.callbacks = {} # name -> callback, for every name in due
+        self.n_scheduled = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, name, delay, callback):
+        """
+        call callback() in delay seconds, unless one is already waiting under this name
+        """
+        with self.condition:
+            if name in self.callbacks:
+                return
+            self.callbacks[name] = callback
+            self.n_scheduled += 1
+            heapq.heappush(self.due, (time.monotonic() + delay, self.n_scheduled, name))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="Timers", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.due) == 0 or self.due[0][0] > time.monotonic():
+                    self.condition.wait(None if len(self.due) == 0 else self.due[0][0] - time.monotonic())
+                _, _, name = heapq.heappop(self.due)
+                callback = self.callbacks.pop(name)
+            try:
+                callback()
+            except Exception:
+                logging.getLogger(__name__).exception("Timer %s failed", name)
+
+timers = Timers()
+
+# how long after a ballot changes a live poll its results are recomputed
+# in the background, if nothing has shown them before then
+ELECTION_DELAY = 1.0
+
+def run_election(bot_data, poll_id):
+    poll = bot_data.get(poll_id)
+    if poll is not None:
+        poll.update_results()
+
+def schedule_election(context, poll):
+    bot_data, poll_id = context.bot_data, poll.id
+    timers.schedule("election:" + poll_id, ELECTION_DELAY, lambda: run_election(bot_data, poll_id))
+
+# how long after a tap a ballot is edited; every tap in between is
+# coalesced into that one edit
+BALLOT_DELAY = 0.5
+
+def update_ballot(bot, bot_data, poll_id, user):
+    poll = bot_data.get(poll_id)
+    vote = None if poll is None else poll.votes.get(user)
+    if vote is not None: # or it was retracted and its ballot deleted
+        vote.update_ballot(poll, bot)
+
+def schedule_ballot_update(context, poll, user):
+    bot, bot_data, poll_id = context.bot, context.bot_data, poll.id
+    timers.schedule("ballot:{}:{}".format(poll_id, user), BALLOT_DELAY,
+        lambda: update_ballot(bot, bot_data, poll_id, user))
+
+# a poll keeps at most this many of its messages up to date, dropping the oldest
+MAX_TRACKED_MESSAGES = 20
+# seconds between pushes, while any are pending
+PUSH_INTERVAL = 1.0
+# Telegram allows about 20 messages a minute in a group and 30 a second overall
+CHAT_EDIT_INTERVAL = 3.0
+MAX_EDITS_PER_PUSH = 20
+
+def message_chat(message):
+    """
+    what edits to 'message' are throttled by: its chat, or for an inline
+    message (whose chat the bot isn't told) the message itself
+    """
+    return message[0] if isinstance(message, tuple) else message
+
+class ResultsPusher:
+    """
+    edits the messages polls have been posted to after the polls change, so
+    nobody has to press Refresh; changes are coalesced per message until it
+    can be edited, which is at most once every CHAT_EDIT_INTERVAL per chat
+    and MAX_EDITS_PER_PUSH per PUSH_INTERVAL overall
+    """
+    def __init__(self):
+        self.pending = {} # message -> poll id, oldest change first
+        self.last_edit = {} # chat -> when a message in it was last edited
+
+    def poll_changed(self, poll):
+        with messages_lock:
+            for message in poll.messages:
+                self.pending.setdefault(message, poll.id)
+
+    def edited(self, message, now=None):
+        """
+        record an edit made elsewhere, e.g. answering a Refresh click
+        """
+        with messages_lock:
+            self.pending.pop(message, None)
+            self.last_edit[message_chat(message)] = time.monotonic() if now is None else now
+
+    def has_pending(self):
+        with messages_lock:
+            return len(self.pending) > 0
 
-        self.poll.update_winners_if_live()
+    def push(self, bot, bot_data, now=None):
+        """
+        the edits themselves are made without holding messages_lock, which
+        is only taken to pick each message and to record how its edit went
+        """
+        if now is None:
+            now = time.monotonic()
+        with messages_lock:
+            self.last_edit = { chat: at for chat, at in self.last_edit.items() if now - at < CHAT_EDIT_INTERVAL }
+            due = list(self.pending.items())
+
+        n_edits = 0
+        for message, poll_id in due:
+            if n_edits >= MAX_EDITS_PER_PUSH:
+                break
+            chat = message_chat(message)
+            poll = bot_data.get(poll_id)
+            with messages_lock:
+                if chat in self.last_edit:
+                    continue # edited too recently, try again next time
+                if self.pending.pop(message, None) is None:
+                    continue # edited elsewhere since
+                admin = None if poll is None else poll.messages.get(message)
+            if admin is None:
+                continue # no longer tracked
+
+            try:
+                sent = self.edit(bot, poll, message, admin)
+            except RetryAfter as e:
+                self.retry(message, poll_id, now + e.retry_after)
+                continue
+            except BadRequest:
+                sent = True
+                poll.forget_message(message) # deleted, or otherwise can't be edited anymore
+            except NetworkError:
+                self.retry(message, poll_id, now)
+                continue
+            except Unauthorized:
+                sent = True
+                poll.forget_message(message) # the bot was removed from the chat
+            except TelegramError:
+                sent = True
+            if sent: # skipped edits don't count towards the limits
+                with messages_lock:
+                    self.last_edit[chat] = now
+                n_edits += 1
+        return n_edits
+
+    def retry(self, message, poll_id, edited_at):
+        """
+        put back a message whose edit failed, to be tried again once its
+        chat may be edited after edited_at
+        """
+        with messages_lock:
+            self.pending.setdefault(message, poll_id)
+            self.last_edit[message_chat(message)] = edited_at
+
+    def edit(self, bot, poll, message, admin):
+        if admin:
+            reply_markup = poll.get_admin_buttons()
+        else:
+            reply_markup = poll.get_public_buttons()
+        if isinstance(message, tuple):
+            target = dict(chat_id=message[0], message_id=message[1])
+        else:
+            target = dict(inline_message_id=message)
+        return message_edits.edit(message, poll.get_html_body(), reply_markup,
+            lambda: bot.edit_message_text(text=poll.get_html_repr(), parse_mode=telegram.ParseMode.HTML,
+            reply_markup=reply_markup, **target))
+
+results_pusher = ResultsPusher()
+
+def push_results(bot, bot_data):
+    try:
+        results_pusher.push(bot, bot_data)
+    finally:
+        if results_pusher.has_pending():
+            schedule_push(bot, bot_data)
+
+def schedule_push(bot, bot_data):
+    timers.schedule("push", PUSH_INTERVAL, lambda: push_results(bot, bot_data))
+
+def callback_message(query):
+    """
+    the message a callback query's button is on, as Poll.messages has it
+    """
+    if query.inline_message_id is not None:
+        return query.inline_message_id
+    return (query.message.chat_id, query.message.message_id)
+
+def simplify_str(s):
+    return "".join(c.lower() for c in s if c.isalnum())
+
+def trigrams(s):
+    return { s[i:i+3] for i in range(len(s) - 2) }
+
+class PollSearchIndex:
+    """
+    one user's ongoing polls, found by any part of their question ignoring
+    case and everything but letters and digits; questions are simplified
+    once, and queries of three or more characters only check the polls
+    that share all of their trigrams
+    """
+    def __init__(self, polls, n_active):
+        self.n_active = n_active # len(active_polls) when built, see get_search_index
+        self.questions = {} # poll id -> simplified question
+        self.order = {} # poll id -> position, so results come in a stable order
+        self.postings = collections.defaultdict(set) # trigram -> poll ids
+        for poll in polls:
+            if poll.ongoing:
+                question = simplify_str(poll.question)
+                self.questions[poll.id] = question
+                self.order[poll.id] = len(self.order)
+                for trigram in trigrams(question):
+                    self.postings[trigram].add(poll.id)
+
+    def search(self, query):
+        """
+        ids of the polls whose question contains query, in a stable order
+        """
+        needle = simplify_str(query)
+        if len(needle) < 3:
+            return [ poll_id for poll_id, question in self.questions.items() if needle in question ]
+
+        postings = sorted((self.postings.get(trigram, set()) for trigram in trigrams(needle)), key=len)
+        candidates = set.intersection(*postings)
+        return sorted((poll_id for poll_id in candidates if needle in self.questions[poll_id]),
+            key=self.order.__getitem__)
+
+    def discard(self, poll_id):
+        question = self.questions.pop(poll_id, None)
+        if question is not None:
+            for trigram in trigrams(question):
+                self.postings[trigram].discard(poll_id)
+
+SEARCH_INDEX_CACHE_SIZE = 1000
+search_indexes = collections.OrderedDict() # user -> PollSearchIndex, least recently used first
+
+def get_search_index(context, user):
+    """
+    this user's PollSearchIndex, rebuilt whenever their active_polls has
+    grown since it was built; polls are only ever added to it
+    """
+    index = search_indexes.get(user)
+    if index is None or index.n_active != len(context.user_data.get("active_polls", ())):
+        polls = get_user_polls(context)
+        index = search_indexes[user] = PollSearchIndex(polls, len(context.user_data["active_polls"]))
+    search_indexes.move_to_end(user)
+    if len(search_indexes) > SEARCH_INDEX_CACHE_SIZE:
+        search_indexes.popitem(last=False)
+    return index
+
+# results per answer to an inline query, the rest are fetched as the user scrolls
+INLINE_PAGE_SIZE = 20
+# seconds Telegram may reuse an answer for the same user and query
+INLINE_CACHE_TIME = 10
 
 class CreationStatus(Enum):
     WAITING = 1
@@ -392,7 +1125,10 @@ def poll_done_handler(update, context):
             poll = Poll(context.user_data["pending_question"],
                 context.user_data["pending_options"], context.user_data["pending_results_live"],
                 update.message.from_user.id)
+            while poll_index.lookup(context.bot_data, poll.handle) is not None:
+                poll.new_id() # handles are short enough to collide, however rarely
             context.bot_data[poll.id] = poll
+            poll_index.add(poll)
 
             context.bot.send_message(chat_id=update.message.chat.id,
                 text="Successfully created poll!")
@@ -401,7 +1137,7 @@ def poll_done_handler(update, context):
             if "active_polls" not in context.user_data:
                 context.user_data["active_polls"] = set()
 
-            context.user_data["active_polls"].add(poll)
+            context.user_data["active_polls"].add(poll.id)
 
             context.user_data["create_status"] = CreationStatus.WAITING # now waiting for another poll
 
@@ -428,7 +1164,7 @@ def cancel_handler(update, context):
 
 def poll_list_handler(update, context):
     if update.message.chat.type == "private":
-        polls = context.user_data.get("active_polls", [])
+        polls = get_user_polls(context)
         if len(polls) == 0:
             update.message.reply_text(text="You don't seem to have any polls! You can make one with /newpoll")
         else:
@@ -466,70 +1202,96 @@ def message_handler(update, context):
             context.bot.send_message(chat_id=update.message.chat.id, text=msg)
 
 def inline_query_handler(update, context):
-    def simplify_str(s):
-        return "".join(c.lower() for c in s if c.isalnum())
-    def contains(needle, haystack):
-        return simplify_str(haystack).find(simplify_str(needle)) != -1
+    inline_query = update.inline_query
+    index = get_search_index(context, inline_query.from_user.id)
+
+    out_polls = []
+    for poll_id in index.search(inline_query.query):
+        poll = context.bot_data.get(poll_id)
+        if poll is not None and poll.ongoing:
+            out_polls.append(poll)
+        else:
+            index.discard(poll_id) # closed since the index was built
 
-    query = update.inline_query.query
-    out_polls = context.user_data.get("active_polls", [])
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    page = out_polls[offset:offset + INLINE_PAGE_SIZE]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(out_polls) else ""
 
-    output_options = [ poll.get_inline_result() \
-        for poll in out_polls \
-        if ( len(query) == 0 or contains(query, poll.question) ) and \
-        poll.ongoing \
-    ]
+    context.bot.answer_inline_query(inline_query.id, results=[ poll.get_inline_result() for poll in page ],
+        is_personal=True, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
 
-    context.bot.answer_inline_query(update.inline_query.id, results=output_options, is_personal=True)
+def chosen_inline_result_handler(update, context):
+    """
+    only sent if inline feedback is enabled with @BotFather's /setinlinefeedback
+    """
+    result = update.chosen_inline_result
+    poll = context.bot_data.get(result.result_id)
+    if poll is not None and result.inline_message_id is not None:
+        poll.track_message(result.inline_message_id, False)
 
 def callback_handler(update, context):
     decoded_data = decode_callback(update.callback_query.data)
     req_type = decoded_data[0]
-    poll = context.bot_data.get(decoded_data[1])
+    poll = poll_index.find(context.bot_data, decoded_data[1])
     user_id = update.callback_query.from_user.id
+    # straight away, so the button stops spinning while the edits below wait
+    # on Telegram or for schedule_ballot_update
+    update.callback_query.answer()
 
     if req_type == CallbackDataType.CLOSING_POLL:
         poll.close()
         req_type = CallbackDataType.REFRESH_ADMIN
-        # FIXME closing a poll should also trigger a refresh but this seems messy
-
-    if req_type == CallbackDataType.REFRESH:
-        try:
-            update.callback_query.edit_message_text(poll.get_html_repr(), parse_mode=telegram.ParseMode.HTML,
-                reply_markup=poll.get_public_buttons())
-        except TelegramError:
-            pass # ignore error if message was not modified
-    elif req_type == CallbackDataType.REFRESH_ADMIN:
+        results_pusher.poll_changed(poll) # every other message loses its buttons too
+        schedule_push(context.bot, context.bot_data)
+
+    if req_type in (CallbackDataType.REFRESH, CallbackDataType.REFRESH_ADMIN):
+        # also picks up messages posted before polls tracked them
+        message = callback_message(update.callback_query)
+        poll.track_message(message, req_type == CallbackDataType.REFRESH_ADMIN)
+        results_pusher.edited(message)
+        if req_type == CallbackDataType.REFRESH:
+            reply_markup = poll.get_public_buttons()
+        else:
+            reply_markup = poll.get_admin_buttons()
         try:
-            update.callback_query.edit_message_text(poll.get_html_repr(), parse_mode=telegram.ParseMode.HTML,
-                reply_markup=poll.get_admin_buttons())
+            message_edits.edit(message, poll.get_html_body(), reply_markup,
+                lambda: update.callback_query.edit_message_text(poll.get_html_repr(),
+                parse_mode=telegram.ParseMode.HTML, reply_markup=reply_markup))
         except TelegramError:
-            pass # ignore error if message was not modified
+            pass
     else:
         vote = poll.add_vote(user_id) # should generate vote if necessary
 
         if req_type == CallbackDataType.STARTING_VOTE:
-            vote.send_ballot(context.bot)
+            vote.send_ballot(poll, context.bot)
         elif req_type == CallbackDataType.SELECTING_OPTION:
             opt = decoded_data[2]
-            vote.tap_option(opt)
+            vote.tap_option(poll, opt)
         elif req_type == CallbackDataType.CHANGE_OF_RANK:
-            vote.clear_current_ranking()
+            vote.clear_current_ranking(poll)
         elif req_type == CallbackDataType.SELECTING_RANK:
             rank = decoded_data[2]
-            vote.tap_rank(rank)
+            vote.tap_rank(poll, rank)
         elif req_type == CallbackDataType.SUBMITTING_VOTE:
-            vote.finalize()
+            vote.finalize(poll)
         elif req_type == CallbackDataType.RETRACTING_VOTE:
-            vote.retract_vote()
+            vote.retract_vote(poll, context.bot)
 
-        vote.update_ballot()
-
-    update.callback_query.answer()
+        if req_type != CallbackDataType.STARTING_VOTE: # which sent a new, up to date ballot
+            schedule_ballot_update(context, poll, user_id)
+        if poll.results_dirty:
+            schedule_election(context, poll)
+        results_pusher.poll_changed(poll)
+        schedule_push(context.bot, context.bot_data)
 
 
 def main():
-    db_persistence = PostgresPersistence(postgres_url=os.environ["DATABASE_URL"])
+    persistence_options = dict(incremental=True, compression="zlib", write_behind=1.0)
+    if "DATABASE_URL" in os.environ:
+        db_persistence = PostgresPersistence(postgres_url=os.environ["DATABASE_URL"], **persistence_options)
+    else: # single-node deployments and local testing
+        db_persistence = SQLitePersistence(os.environ.get("SQLITE_PATH", "rankedpairs.sqlite3"),
+            **persistence_options)
     updater = Updater(token=API_KEY, persistence=db_persistence)
 
     dispatcher = updater.dispatcher
@@ -546,10 +1308,13 @@ def main():
     dispatcher.add_handler(MessageHandler(Filters.text, message_handler))
 
     dispatcher.add_handler(InlineQueryHandler(inline_query_handler))
+    dispatcher.add_handler(ChosenInlineResultHandler(chosen_inline_result_handler))
     dispatcher.add_handler(CallbackQueryHandler(callback_handler))
 
     dispatcher.add_error_handler(handle_error)
 
+    timers.schedule("metrics", METRICS_INTERVAL, log_metrics)
+
     # allows viewing of exceptions
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -15,36 +15,43 @@
 #
 # SEE: https://github.com/ncurrault/python-telegram-bot-postgres-persistence/
 
-import pickle
-from collections import defaultdict
+import threading
+import time
+from contextlib import contextmanager
 from urllib.parse import urlparse
 import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from typing import (
     Any,
     Dict,
+    List,
     Optional,
     Tuple,
     overload,
-    cast,
-    DefaultDict,
 )
 
-from telegram.ext import BasePersistence
-from telegram.ext.utils.types import UD, CD, BD, ConversationDict, CDCData
+from telegram.ext.utils.types import UD, CD, BD
 from telegram.ext.contexttypes import ContextTypes
 
-class PostgresPersistence(BasePersistence[UD, CD, BD]):
+from storagepersistence import StoragePersistence
+
+
+class PostgresPersistence(StoragePersistence[UD, CD, BD]):
     __slots__ = (
         'postgres_url',
-        'on_flush',
-        'user_data',
-        'chat_data',
-        'bot_data',
-        'callback_data',
-        'conversations',
-        'context_types',
+        'min_connections',
+        'max_connections',
+        'health_check_interval',
+        'pool',
+        'pool_lock',
+        'pool_slots',
+        'last_used',
     )
 
+    # errors after which a connection can't be trusted anymore
+    CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
     @overload
     def __init__(
         self: 'PostgresPersistence[Dict, Dict, Dict]',
@@ -54,6 +61,14 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         store_bot_data: bool = True,
         on_flush: bool = True,
         store_callback_data: bool = False,
+        min_connections: int = 1,
+        max_connections: int = 4,
+        health_check_interval: float = 30.0,
+        incremental: bool = False,
+        compression: Optional[str] = None,
+        keep_snapshots: Optional[int] = None,
+        prune_interval: float = 600.0,
+        write_behind: Optional[float] = None,
     ):
         ...
 
@@ -67,6 +82,14 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         on_flush: bool = True,
         store_callback_data: bool = False,
         context_types: ContextTypes[Any, UD, CD, BD] = None,
+        min_connections: int = 1,
+        max_connections: int = 4,
+        health_check_interval: float = 30.0,
+        incremental: bool = False,
+        compression: Optional[str] = None,
+        keep_snapshots: Optional[int] = None,
+        prune_interval: float = 600.0,
+        write_behind: Optional[float] = None,
     ):
         ...
 
@@ -79,12 +102,27 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
         on_flush: bool = True,
         store_callback_data: bool = False,
         context_types: ContextTypes[Any, UD, CD, BD] = None,
+        min_connections: int = 1,
+        max_connections: int = 4,
+        health_check_interval: float = 30.0,
+        incremental: bool = False,
+        compression: Optional[str] = None,
+        keep_snapshots: Optional[int] = None,
+        prune_interval: float = 600.0,
+        write_behind: Optional[float] = None,
     ):
         super().__init__(
             store_user_data=store_user_data,
             store_chat_data=store_chat_data,
             store_bot_data=store_bot_data,
+            on_flush=on_flush,
             store_callback_data=store_callback_data,
+            context_types=context_types,
+            incremental=incremental,
+            compression=compression,
+            keep_snapshots=keep_snapshots,
+            prune_interval=prune_interval,
+            write_behind=write_behind,
         )
 
         parsed_url = urlparse(postgres_url)
@@ -96,153 +134,176 @@ class PostgresPersistence(BasePersistence[UD, CD, BD]):
             "port": parsed_url.port,
         }
 
-        self.on_flush = on_flush
-        self.user_data: Optional[DefaultDict[int, UD]] = None
-        self.chat_data: Optional[DefaultDict[int, CD]] = None
-        self.bot_data: Optional[BD] = None
-        self.callback_data: Optional[CDCData] = None
-        self.conversations: Optional[Dict[str, Dict[Tuple, object]]] = None
-        self.context_types = cast(ContextTypes[Any, UD, CD, BD], context_types or ContextTypes())
+        # connections are opened lazily and up to min_connections of them are
+        # kept open while idle, for reuse across loads and dumps
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.health_check_interval = health_check_interval
+        self.pool: Optional[ThreadedConnectionPool] = None
+        self.pool_lock = threading.Lock()
+        self.pool_slots = threading.BoundedSemaphore(max_connections)
+        self.last_used: Dict[Any, float] = {} # guarded by pool_lock
+
+    def _checkout(self) -> Tuple[ThreadedConnectionPool, Any]:
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadedConnectionPool(
+                    self.min_connections, self.max_connections, **self.psycopg2_kwargs)
+            pool = self.pool
 
-    def _load(self) -> None:
-        conn = psycopg2.connect(**self.psycopg2_kwargs)
+        while True:
+            conn = pool.getconn()
+            with self.pool_lock:
+                last_used = self.last_used.get(conn) # None for brand new connections
+            if conn.closed:
+                self._discard(pool, conn)
+            elif last_used is not None and time.monotonic() - last_used > self.health_check_interval \
+                    and not self._is_healthy(conn):
+                self._discard(pool, conn)
+            else:
+                return pool, conn
+
+    def _is_healthy(self, conn: Any) -> bool:
         try:
             with conn.cursor() as cur:
-                cur.execute("SELECT data FROM telegram_persistence ORDER BY updated DESC LIMIT 1;")
-                row = cur.fetchone()
-                if row is None:
-                    self.conversations = {}
-                    self.user_data = defaultdict(self.context_types.user_data)
-                    self.chat_data = defaultdict(self.context_types.chat_data)
-                    self.bot_data = self.context_types.bot_data()
-                    self.callback_data = None
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, pool: ThreadedConnectionPool, conn: Any) -> None:
+        with self.pool_lock:
+            self.last_used.pop(conn, None)
+            # whatever broke this connection (e.g. a database restart) has probably
+            # broken the idle ones too, so health check each of them before reuse
+            for other in self.last_used:
+                self.last_used[other] = 0.0
+        pool.putconn(conn, close=True)
+
+    def _release(self, pool: ThreadedConnectionPool, conn: Any) -> None:
+        with self.pool_lock:
+            self.last_used[conn] = time.monotonic()
+        pool.putconn(conn) # rolls back whatever was left open
+
+    @contextmanager
+    def _connection(self) -> Any:
+        """
+        Borrow a connection from the pool, blocking while all of them are in use.
+        Connections that fail are closed instead of being returned to the pool.
+        """
+        with self.pool_slots:
+            pool, conn = self._checkout()
+            try:
+                yield conn
+            except self.CONNECTION_ERRORS:
+                self._discard(pool, conn)
+                raise
+            except BaseException:
+                if conn.closed:
+                    self._discard(pool, conn)
                 else:
-                    data = pickle.loads(row[0])
-                    self.user_data = defaultdict(self.context_types.user_data, data['user_data'])
-                    self.chat_data = defaultdict(self.context_types.chat_data, data['chat_data'])
-                    # For backwards compatibility with dumps not containing bot data
-                    self.bot_data = data.get('bot_data', self.context_types.bot_data())
-                    self.callback_data = data.get('callback_data', {})
-                    self.conversations = data['conversations']
-        except pickle.UnpicklingError as exc:
-            raise TypeError(f"Database does not contain valid pickle data") from exc
-        except Exception as exc:
-            raise TypeError(f"Something went wrong loading from database/unpickling") from exc
-        finally:
-            conn.close()
-
-    def _dump(self) -> None:
-        conn = psycopg2.connect(**self.psycopg2_kwargs)
+                    self._release(pool, conn)
+                raise
+            else:
+                self._release(pool, conn)
+
+    def _run(self, operation: Any) -> Any:
+        """
+        Run operation(connection), retrying once on a fresh connection if the
+        pooled one turns out to be broken.
+        """
         try:
+            with self._connection() as conn:
+                return operation(conn)
+        except self.CONNECTION_ERRORS:
+            with self._connection() as conn:
+                return operation(conn)
+
+    def _close_pool(self) -> None:
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+                self.last_used.clear()
+
+    def _close(self) -> None:
+        self._close_pool()
+
+    def _read_snapshot(self) -> Optional[bytes]:
+        def fetch_latest(conn: Any) -> Optional[Tuple]:
+            with conn.cursor() as cur:
+                cur.execute("SELECT data FROM telegram_persistence ORDER BY updated DESC LIMIT 1;")
+                return cur.fetchone()
+
+        row = self._run(fetch_latest)
+        return None if row is None else row[0]
+
+    def _write_snapshot(self, data: bytes) -> None:
+        def insert_snapshot(conn: Any) -> None:
+            with conn.cursor() as cur:
+                cur.execute("INSERT INTO telegram_persistence (data) VALUES (%s);", (data,))
+            conn.commit()
+
+        self._run(insert_snapshot)
+
+    def _delete_snapshots(self, keep: int) -> int:
+        def delete_old(conn: Any) -> int:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM telegram_persistence WHERE updated < ("
+                    "SELECT updated FROM telegram_persistence ORDER BY updated DESC OFFSET %s LIMIT 1);",
+                    (keep - 1,))
+                deleted = cur.rowcount
+            conn.commit()
+            return deleted
+
+        return self._run(delete_old)
+
+    def _read_entries(self, lazy_kinds: Tuple[str, ...]) -> Optional[List[Tuple[str, str, Optional[bytes]]]]:
+        def fetch_entries(conn: Any) -> Optional[List[Tuple]]:
             with conn.cursor() as cur:
-                data = {
-                    'conversations': self.conversations,
-                    'user_data': self.user_data,
-                    'chat_data': self.chat_data,
-                    'bot_data': self.bot_data,
-                    'callback_data': self.callback_data,
-                }
-                data_serialized = pickle.dumps(data)
-                cur.execute("INSERT INTO telegram_persistence (data) VALUES (%s);", (data_serialized,))
-                conn.commit()
-        finally:
-            conn.close()
-
-    def get_user_data(self) -> DefaultDict[int, UD]:
-        if self.user_data:
-            pass
-        else:
-            self._load()
-        return self.user_data  # type: ignore[return-value]
-
-    def get_chat_data(self) -> DefaultDict[int, CD]:
-        if self.chat_data:
-            pass
-        else:
-            self._load()
-        return self.chat_data  # type: ignore[return-value]
-
-    def get_bot_data(self) -> BD:
-        if self.bot_data:
-            pass
-        else:
-            self._load()
-        return self.bot_data  # type: ignore[return-value]
-
-    def get_callback_data(self) -> Optional[CDCData]:
-        if self.callback_data:
-            pass
-        else:
-            self._load()
-        if self.callback_data is None:
-            return None
-        return self.callback_data[0], self.callback_data[1].copy()
-
-    def get_conversations(self, name: str) -> ConversationDict:
-        if self.conversations:
-            pass
-        else:
-            self._load()
-        return self.conversations.get(name, {}).copy()  # type: ignore[union-attr]
-
-    def update_conversation(
-        self, name: str, key: Tuple[int, ...], new_state: Optional[object]
-    ) -> None:
-        if not self.conversations:
-            self.conversations = {}
-        if self.conversations.setdefault(name, {}).get(key) == new_state:
-            return
-        self.conversations[name][key] = new_state
-        if not self.on_flush:
-            self._dump()
-
-    def update_user_data(self, user_id: int, data: UD) -> None:
-        if self.user_data is None:
-            self.user_data = defaultdict(self.context_types.user_data)
-        if self.user_data.get(user_id) == data:
-            return
-        self.user_data[user_id] = data
-        if not self.on_flush:
-            self._dump()
-
-    def update_chat_data(self, chat_id: int, data: CD) -> None:
-        if self.chat_data is None:
-            self.chat_data = defaultdict(self.context_types.chat_data)
-        if self.chat_data.get(chat_id) == data:
-            return
-        self.chat_data[chat_id] = data
-        if not self.on_flush:
-            self._dump()
-
-    def update_bot_data(self, data: BD) -> None:
-        if self.bot_data == data:
-            return
-        self.bot_data = data
-        if not self.on_flush:
-            self._dump()
-
-    def update_callback_data(self, data: CDCData) -> None:
-        if self.callback_data == data:
-            return
-        self.callback_data = (data[0], data[1].copy())
-        if not self.on_flush:
-            self._dump()
-
-    def refresh_user_data(self, user_id: int, user_data: UD) -> None:
-        pass # do nothing
-
-    def refresh_chat_data(self, chat_id: int, chat_data: CD) -> None:
-        pass # do nothing
-
-    def refresh_bot_data(self, bot_data: BD) -> None:
-        pass # do nothing
-
-    def flush(self) -> None:
-        if (
-            self.user_data
-            or self.chat_data
-            or self.bot_data
-            or self.callback_data
-            or self.conversations
-        ):
-            self._dump()
+                cur.execute("SELECT to_regclass('telegram_persistence_entries') IS NOT NULL;")
+                if not cur.fetchone()[0]:
+                    cur.execute(
+                        "CREATE TABLE telegram_persistence_entries ("
+                        "kind TEXT NOT NULL, "
+                        "key TEXT NOT NULL, "
+                        "data BYTEA NOT NULL, "
+                        "updated TIMESTAMP NOT NULL DEFAULT now(), "
+                        "PRIMARY KEY (kind, key));"
+                    )
+                    conn.commit()
+                    return None
+                # everything but the values of lazily fetched kinds
+                cur.execute(
+                    "SELECT kind, key, CASE WHEN kind IN %s THEN NULL ELSE data END "
+                    "FROM telegram_persistence_entries;", (lazy_kinds,))
+                return cur.fetchall()
+
+        return self._run(fetch_entries)
+
+    def _read_entry(self, kind: str, key: str) -> bytes:
+        def fetch(conn: Any) -> Tuple:
+            with conn.cursor() as cur:
+                cur.execute("SELECT data FROM telegram_persistence_entries WHERE kind = %s AND key = %s;",
+                    (kind, key))
+                return cur.fetchone()
+
+        return self._run(fetch)[0]
+
+    def _write_entries(self, upserts: List[Tuple[str, str, bytes]], deletes: List[Tuple[str, str]]) -> None:
+        def write_entries(conn: Any) -> None:
+            with conn.cursor() as cur:
+                if len(upserts) > 0:
+                    execute_values(cur,
+                        "INSERT INTO telegram_persistence_entries (kind, key, data) VALUES %s "
+                        "ON CONFLICT (kind, key) DO UPDATE SET data = EXCLUDED.data, updated = now();",
+                        upserts)
+                if len(deletes) > 0:
+                    cur.executemany(
+                        "DELETE FROM telegram_persistence_entries WHERE kind = %s AND key = %s;",
+                        deletes)
+            conn.commit()
+
+        self._run(write_entries)
@@ -1,4 +1,26 @@
-import copy
+import argparse
+import csv
+import os
+import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # tally falls back to pure Python
+
+# upper bound on the (voters x candidates x candidates) comparison array the
+# NumPy tally materializes at once
+NUMPY_CHUNK_CELLS = 1 << 22
+
+# number of ballots tally_stream holds in memory at once (per worker)
+STREAM_CHUNK_SIZE = 10000
+
+# tally_parallel counts fewer ballots than this in-process, since starting
+# a pool of workers would cost more than it saves
+PARALLEL_THRESHOLD = 100000
 
 class Pair:
     def __init__(self, candidateA, candidateB):
@@ -7,6 +29,17 @@ class Pair:
         self.min_cand_votes = 0
         self.max_cand_votes = 0
 
+    @classmethod
+    def from_matrix(cls, matrix, candidateA, candidateB):
+        """
+        build a pair whose vote counts are read off of a pairwise preference
+        matrix (see tally) instead of being accumulated ballot by ballot
+        """
+        pair = cls(candidateA, candidateB)
+        pair.min_cand_votes = matrix[pair.min_candidate][pair.max_candidate]
+        pair.max_cand_votes = matrix[pair.max_candidate][pair.min_candidate]
+        return pair
+
     def process_ballot(self, ballot):
         if ballot[self.min_candidate] > ballot[self.max_candidate]:
             self.min_cand_votes += 1
@@ -42,97 +75,302 @@ class Pair:
         # OR Vxy = Vzw and Vyx < Vwz
         # https://en.wikipedia.org/wiki/Ranked_pairs#Sort
 
-def bfs(graph, source):
+class LockedGraph:
     """
-    get connected component containing some source
+    candidate graph built up during lock-in, which keeps track of every
+    candidate reachable from each candidate as edges are added, so checking
+    whether an edge would create a cycle is a single lookup instead of a
+    traversal of the whole graph
     """
-    to_explore = {source}
-    visited = set()
-    while len(to_explore) > 0:
-        v = to_explore.pop()
-        if v not in visited:
-            to_explore.update(graph[v])
-            visited.add(v)
-    return visited
+    def __init__(self, candidates):
+        self.candidates = set(candidates)
+        # bit c of reachable[v] is set iff there is a path from v to c
+        # (every candidate trivially reaches itself)
+        self.reachable = { v: 1 << v for v in self.candidates }
+        self.has_parent = 0 # bit c is set iff c has in-degree >= 1
 
-def creates_cycle(graph, source, destination):
-    return source in bfs(graph, destination)
+    def creates_cycle(self, source, destination):
+        return (self.reachable[destination] >> source) & 1 == 1
 
-def get_sources(graph):
-    sources = set(graph.keys())
-    for losers in graph.values():
-        sources -= losers
-        # all of the nodes mentioned in these sets have in-degree >= 1
-        # because there's an edge from some key to it
-    return sources
-    # sources have in-degree 0 by definition
+    def add_edge(self, source, destination):
+        self.has_parent |= 1 << destination
 
-def get_winners(ballots):
+        gained = self.reachable[destination]
+        if self.reachable[source] | gained == self.reachable[source]:
+            return # already reachable, nothing new for anyone upstream
+
+        for v, reach in self.reachable.items():
+            if (reach >> source) & 1:
+                self.reachable[v] = reach | gained
+
+    def get_sources(self):
+        return { v for v in self.candidates if not (self.has_parent >> v) & 1 }
+        # sources have in-degree 0 by definition
+
+def empty_matrix(n_options):
+    return [ [0] * n_options for _ in range(n_options) ]
+
+def add_ballot(matrix, ballot, weight=1):
+    """
+    add a single ballot to a pairwise preference matrix in place, where
+    [a][b] counts the voters who scored candidate a strictly above candidate b
+
+    use weight=-1 to retract a ballot that was previously added
+    """
+    n_options = len(ballot)
+    for a in range(n_options):
+        row = matrix[a]
+        score = ballot[a]
+        for b in range(n_options):
+            if score > ballot[b]:
+                row[b] += weight
+
+def add_matrix(matrix, other):
+    """
+    add the counts of one pairwise preference matrix into another, in place
+    """
+    for row, other_row in zip(matrix, other):
+        for b, votes in enumerate(other_row):
+            row[b] += votes
+
+def ranks_to_scores(rankings):
+    """
+    map a ballot of ranks (1 being the best, 0 meaning abstain) to the scores
+    the election expects (the higher the better, abstain scoring lowest)
+    """
+    n_options = len(rankings)
+    return [ n_options - rank if rank > 0 else 0 for rank in rankings ]
+
+def tally(ballots):
     """
     'ballots' should be a 2D array: rows are voters, columns are candidates,
     integer at [row][column] is the score this voter gave that candidate
     (the higher the better)
+
+    returns the pairwise preference matrix for these ballots, computed with
+    NumPy when it is installed
+    """
+    if np is not None:
+        return tally_numpy(ballots)
+    return tally_python(collapse_ballots(ballots))
+
+def tally_weighted(weighted_ballots):
+    """
+    like tally, but 'weighted_ballots' is a list of (ballot, count) pairs,
+    each standing for 'count' voters who all cast that same ballot
+    """
+    if np is not None:
+        return tally_numpy([ ballot for ballot, _ in weighted_ballots ],
+            [ count for _, count in weighted_ballots ])
+    return tally_python(weighted_ballots)
+
+def collapse_ballots(ballots):
+    """
+    group identical ballots together, returning (ballot, count) pairs that
+    can be passed to tally_weighted
+    """
+    return list(Counter(map(tuple, ballots)).items())
+
+def sum_matrices(matrices, n_options=None):
+    """
+    add up partial pairwise preference matrices
+
+    'n_options' is only needed to get an empty matrix back if there turn out
+    to be no matrices at all
+    """
+    matrix = None
+    for partial in matrices:
+        if matrix is None:
+            matrix = partial
+        else:
+            add_matrix(matrix, partial)
+
+    if matrix is None:
+        if n_options is None:
+            raise ValueError("no ballots to tally")
+        matrix = empty_matrix(n_options)
+    return matrix
+
+def map_bounded(executor, fn, iterable, max_pending):
+    """
+    like executor.map, but only reads up to 'max_pending' items of 'iterable'
+    ahead of the results instead of submitting all of them up front
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+def tally_stream(ballots, n_options=None, chunk_size=STREAM_CHUNK_SIZE, workers=1):
+    """
+    like tally, but 'ballots' can be any iterable, e.g. a generator reading
+    ballots from a file. ballots are consumed 'chunk_size' at a time and only
+    the running matrix is kept, so memory does not grow with the number of
+    voters
+
+    with workers > 1 (or None for one per core), chunks are tallied by a pool
+    of worker processes
+
+    'n_options' is only needed to get an empty matrix back if there turn out
+    to be no ballots at all
+    """
+    ballots = iter(ballots)
+    chunks = iter(lambda: list(islice(ballots, chunk_size)), [])
+
+    if workers == 1:
+        return sum_matrices(map(tally, chunks), n_options)
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum_matrices(map_bounded(executor, tally, chunks, 2 * workers), n_options)
+
+def tally_parallel(ballots, workers=None, threshold=PARALLEL_THRESHOLD):
+    """
+    like tally, but splits the ballots evenly across a pool of 'workers'
+    processes (one per core by default), each of which tallies a partial
+    matrix, and sums the results
+
+    elections with fewer than 'threshold' ballots are tallied in-process
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(ballots) < threshold:
+        return tally(ballots)
+
+    if np is not None:
+        ballots = np.asarray(ballots, dtype=np.int64) # far cheaper to send to workers than lists
+
+    chunk_size = -(-len(ballots) // workers) # ceiling division
+    chunks = [ ballots[start:start + chunk_size] for start in range(0, len(ballots), chunk_size) ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum_matrices(executor.map(tally, chunks))
+
+def tally_python(weighted_ballots):
+    matrix = empty_matrix(len(weighted_ballots[0][0]))
+    for ballot, count in weighted_ballots:
+        add_ballot(matrix, ballot, count)
+    return matrix
+
+def tally_numpy(ballots, counts=None):
+    """
+    vectorized tally: every voter's scores are compared against each other at
+    once by broadcasting, a bounded number of voters at a time
+
+    if given, counts[i] is the number of voters who cast ballots[i]
     """
-    n_options = len(ballots[0])
+    scores = np.asarray(ballots, dtype=np.int64)
+    if counts is not None:
+        counts = np.asarray(counts, dtype=np.int64)
+    n_options = scores.shape[1]
+    matrix = np.zeros((n_options, n_options), dtype=np.int64)
+
+    chunk_rows = max(1, NUMPY_CHUNK_CELLS // (n_options * n_options))
+    for start in range(0, len(scores), chunk_rows):
+        chunk = scores[start:start + chunk_rows]
+        preferred = chunk[:, :, None] > chunk[:, None, :]
+        if counts is None:
+            matrix += preferred.sum(axis=0)
+        else:
+            matrix += np.tensordot(counts[start:start + chunk_rows], preferred, axes=1)
+
+    return matrix.tolist() # plain ints, so pairs compare exactly as before
+
+def sort_pairs(matrix):
+    """
+    every decided pair of candidates in a pairwise preference matrix,
+    strongest majority first
+    """
+    n_options = len(matrix)
 
     pairs = [ ]
     for a in range(n_options):
         for b in range(a):
-            pairs.append(Pair(a, b))
-
-    for pair in pairs:
-        for ballot in ballots:
-            pair.process_ballot(ballot)
+            pair = Pair.from_matrix(matrix, a, b)
+            if pair.get_winner() is not None:
+                pairs.append(pair)
 
-    ranked_pairs = sorted(pairs, reverse=True) # roll credits!
+    return sorted(pairs, reverse=True) # roll credits!
 
-    # candidate graph, as adjacency map
-    graph = { n: set() for n in range(n_options) }
+def lock_in(ranked_pairs, candidates):
+    """
+    build the candidate graph from pairs sorted by sort_pairs, skipping any
+    pair that would create a cycle
+    """
+    graph = LockedGraph(candidates)
     for pair in ranked_pairs:
         winner, loser = pair.get_winner(), pair.get_loser()
-        if (winner is not None) and not creates_cycle(graph, winner, loser):
-            graph[winner].add(loser)
+        if not graph.creates_cycle(winner, loser):
+            graph.add_edge(winner, loser)
+    return graph
 
-    return get_sources(graph)
-
-def get_ranked_partitions(ballots):
+def get_winners_from_matrix(matrix):
     """
-    'ballots' should be a 2D array: rows are voters, columns are candidates,
-    integer at [row][column] is the score this voter gave that candidate
-    (the higher the better)
+    run the election on a precomputed pairwise preference matrix
+    """
+    return lock_in(sort_pairs(matrix), range(len(matrix))).get_sources()
 
-    works by repeatedly calling get_winners, removing victors, and calling again
-    until all candidates have won and been assigned a rank
+def get_ranked_partitions_from_matrix(matrix):
     """
-    n_options = len(ballots[0])
-    ballots_copy = copy.deepcopy(ballots)
+    like get_ranked_partitions, but for a precomputed pairwise preference matrix
 
-    already_won = set()
+    pairs are tallied and sorted once; each round locks in only the pairs
+    between candidates that have not won yet, then removes that round's
+    victors. this matches demoting victors below abstain on every ballot and
+    re-running the election: a demoted candidate loses every pair against the
+    remaining candidates unanimously and never wins a pair itself, so it can
+    neither block a remaining candidate's edge nor become a source, and (since
+    the sort is stable) the remaining pairs keep their relative order
+    """
+    ranked_pairs = sort_pairs(matrix)
+    remaining = set(range(len(matrix)))
     result = []
 
-    while True:
-        winners = get_winners(ballots_copy)
-        if len(winners.intersection(already_won)) > 0:
-            break
-
-        already_won.update(winners)
+    while len(remaining) > 0:
+        winners = lock_in(ranked_pairs, remaining).get_sources()
+        remaining -= winners
         result.append(winners)
 
-        for w in winners:
-            for ballot in ballots_copy:
-                ballot[w] = -1
-        # ensure this person is worse than abstain so they should never win until all other candidates have been picked
+        ranked_pairs = [ pair for pair in ranked_pairs
+            if pair.min_candidate in remaining and pair.max_candidate in remaining ]
 
-    assert len(already_won) == n_options
     return result
 
+def get_candidate_rankings_from_matrix(matrix):
+    """
+    like get_candidate_rankings, but for a precomputed pairwise preference matrix
+    """
+    return partitions_to_rankings(get_ranked_partitions_from_matrix(matrix))
+
+def get_winners(ballots):
+    """
+    'ballots' should be a 2D array: rows are voters, columns are candidates,
+    integer at [row][column] is the score this voter gave that candidate
+    (the higher the better)
+    """
+    return get_winners_from_matrix(tally(ballots))
+
+def get_ranked_partitions(ballots):
+    """
+    'ballots' should be a 2D array: rows are voters, columns are candidates,
+    integer at [row][column] is the score this voter gave that candidate
+    (the higher the better)
+
+    returns the candidates grouped into sets of equally-ranked candidates,
+    best first
+    """
+    return get_ranked_partitions_from_matrix(tally(ballots))
+
 def get_candidate_rankings(ballots):
     """
     wrapper for get_ranked_partitions, returns results as a single list, where
     the integer at [i] represents the ranking of candidate [i] (1 being the best)
     """
-    partitions = get_ranked_partitions(ballots)
-    rankings = [ None for _ in ballots[0] ]
+    return partitions_to_rankings(get_ranked_partitions(ballots))
+
+def partitions_to_rankings(partitions):
+    rankings = [ None for part in partitions for _ in part ]
 
     rank = 1
     for part in partitions:
@@ -142,3 +380,68 @@ def get_candidate_rankings(ballots):
 
     assert None not in rankings
     return rankings
+
+def get_winners_weighted(weighted_ballots):
+    """
+    get_winners for (ballot, count) pairs, see tally_weighted
+    """
+    return get_winners_from_matrix(tally_weighted(weighted_ballots))
+
+def get_ranked_partitions_weighted(weighted_ballots):
+    """
+    get_ranked_partitions for (ballot, count) pairs, see tally_weighted
+    """
+    return get_ranked_partitions_from_matrix(tally_weighted(weighted_ballots))
+
+def get_candidate_rankings_weighted(weighted_ballots):
+    """
+    get_candidate_rankings for (ballot, count) pairs, see tally_weighted
+    """
+    return get_candidate_rankings_from_matrix(tally_weighted(weighted_ballots))
+
+def read_ballots_csv(reader, n_options, ranks=False):
+    """
+    generate ballots from the rows of a csv.reader positioned after the header,
+    one cell per candidate; blank cells count as abstentions
+    """
+    for row in reader:
+        if len(row) == 0:
+            continue
+        if len(row) != n_options:
+            raise ValueError("line {}: expected {} columns, got {}".format(
+                reader.line_num, n_options, len(row)))
+
+        ballot = [ int(cell) if cell.strip() else 0 for cell in row ]
+        yield ranks_to_scores(ballot) if ranks else ballot
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a ranked-pairs election on ballots read from a CSV file.")
+    parser.add_argument("ballots", type=argparse.FileType("r"),
+        help="CSV file ('-' for stdin) with a header row of candidate names, then one row per ballot")
+    parser.add_argument("--ranks", action="store_true",
+        help="cells are ranks (1 being the best, 0 or blank to abstain) instead of scores (the higher the better)")
+    parser.add_argument("--chunk-size", type=int, default=STREAM_CHUNK_SIZE,
+        help="number of ballots to hold in memory at once per worker (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+        help="number of processes tallying ballots, 0 for one per core (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    with args.ballots as f:
+        reader = csv.reader(f)
+        candidates = next(reader, [])
+        if len(candidates) == 0:
+            parser.error("missing header row of candidate names")
+
+        try:
+            matrix = tally_stream(read_ballots_csv(reader, len(candidates), args.ranks),
+                n_options=len(candidates), chunk_size=args.chunk_size, workers=args.workers)
+        except ValueError as exc:
+            parser.error(str(exc))
+
+    rankings = get_candidate_rankings_from_matrix(matrix)
+    for option_idx in sorted(range(len(candidates)), key=lambda idx: rankings[idx]):
+        print("{}. {}".format(rankings[option_idx], candidates[option_idx]))
+
+if __name__ == "__main__":
+    sys.exit(main())
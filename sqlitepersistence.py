@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Lesser Public License
+# along with this program.  If not, see [http://www.gnu.org/licenses/].
+
+import sqlite3
+import threading
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    overload,
+)
+
+from telegram.ext.utils.types import UD, CD, BD
+from telegram.ext.contexttypes import ContextTypes
+
+from storagepersistence import StoragePersistence
+
+
+class SQLitePersistence(StoragePersistence[UD, CD, BD]):
+    """
+    Stores the bot's data in a local SQLite file, with the same tables as
+    PostgresPersistence. The database is in WAL mode, so loads and lazy
+    fetches aren't blocked while a dump is being written.
+    """
+
+    __slots__ = (
+        'path',
+        'timeout',
+        'local',
+        'connections',
+        'connections_lock',
+    )
+
+    @overload
+    def __init__(
+        self: 'SQLitePersistence[Dict, Dict, Dict]',
+        path: str,
+        store_user_data: bool = True,
+        store_chat_data: bool = True,
+        store_bot_data: bool = True,
+        on_flush: bool = True,
+        store_callback_data: bool = False,
+        timeout: float = 5.0,
+        incremental: bool = False,
+        compression: Optional[str] = None,
+        keep_snapshots: Optional[int] = None,
+        prune_interval: float = 600.0,
+        write_behind: Optional[float] = None,
+    ):
+        ...
+
+    @overload
+    def __init__(
+        self: 'SQLitePersistence[UD, CD, BD]',
+        path: str,
+        store_user_data: bool = True,
+        store_chat_data: bool = True,
+        store_bot_data: bool = True,
+        on_flush: bool = True,
+        store_callback_data: bool = False,
+        context_types: ContextTypes[Any, UD, CD, BD] = None,
+        timeout: float = 5.0,
+        incremental: bool = False,
+        compression: Optional[str] = None,
+        keep_snapshots: Optional[int] = None,
+        prune_interval: float = 600.0,
+        write_behind: Optional[float] = None,
+    ):
+        ...
+
+    def __init__(
+        self,
+        path: str,
+        store_user_data: bool = True,
+        store_chat_data: bool = True,
+        store_bot_data: bool = True,
+        on_flush: bool = True,
+        store_callback_data: bool = False,
+        context_types: ContextTypes[Any, UD, CD, BD] = None,
+        timeout: float = 5.0,
+        incremental: bool = False,
+        compression: Optional[str] = None,
+        keep_snapshots: Optional[int] = None,
+        prune_interval: float = 600.0,
+        write_behind: Optional[float] = None,
+    ):
+        super().__init__(
+            store_user_data=store_user_data,
+            store_chat_data=store_chat_data,
+            store_bot_data=store_bot_data,
+            on_flush=on_flush,
+            store_callback_data=store_callback_data,
+            context_types=context_types,
+            incremental=incremental,
+            compression=compression,
+            keep_snapshots=keep_snapshots,
+            prune_interval=prune_interval,
+            write_behind=write_behind,
+        )
+
+        # sqlite3 connections can't be shared between threads while in use, so
+        # each thread opens its own; timeout is how long a write waits for
+        # another one to finish
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections: List[sqlite3.Connection] = []
+        self.connections_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL;")
+            # in WAL mode, this only gives up durability of the last commits
+            # on power loss, never consistency
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS telegram_persistence ("
+                    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "data BLOB NOT NULL, "
+                    "updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);"
+                )
+            with self.connections_lock:
+                self.connections.append(conn)
+            self.local.conn = conn
+        return conn
+
+    def _close(self) -> None:
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            self.local = threading.local()
+
+    def _read_snapshot(self) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT data FROM telegram_persistence ORDER BY id DESC LIMIT 1;").fetchone()
+        return None if row is None else row[0]
+
+    def _write_snapshot(self, data: bytes) -> None:
+        with self._connection() as conn:
+            conn.execute("INSERT INTO telegram_persistence (data) VALUES (?);", (data,))
+
+    def _delete_snapshots(self, keep: int) -> int:
+        with self._connection() as conn:
+            return conn.execute(
+                "DELETE FROM telegram_persistence WHERE id < ("
+                "SELECT id FROM telegram_persistence ORDER BY id DESC LIMIT 1 OFFSET ?);",
+                (keep - 1,)).rowcount
+
+    def _read_entries(self, lazy_kinds: Tuple[str, ...]) -> Optional[List[Tuple[str, str, Optional[bytes]]]]:
+        conn = self._connection()
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'telegram_persistence_entries';"
+        ).fetchone()
+        if exists is None:
+            with conn:
+                conn.execute(
+                    "CREATE TABLE telegram_persistence_entries ("
+                    "kind TEXT NOT NULL, "
+                    "key TEXT NOT NULL, "
+                    "data BLOB NOT NULL, "
+                    "updated TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                    "PRIMARY KEY (kind, key));"
+                )
+            return None
+        # everything but the values of lazily fetched kinds
+        placeholders = ", ".join("?" for _ in lazy_kinds)
+        return conn.execute(
+            f"SELECT kind, key, CASE WHEN kind IN ({placeholders}) THEN NULL ELSE data END "
+            "FROM telegram_persistence_entries;", lazy_kinds).fetchall()
+
+    def _read_entry(self, kind: str, key: str) -> bytes:
+        return self._connection().execute(
+            "SELECT data FROM telegram_persistence_entries WHERE kind = ? AND key = ?;",
+            (kind, key)).fetchone()[0]
+
+    def _write_entries(self, upserts: List[Tuple[str, str, bytes]], deletes: List[Tuple[str, str]]) -> None:
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT INTO telegram_persistence_entries (kind, key, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data, updated = CURRENT_TIMESTAMP;",
+                upserts)
+            conn.executemany(
+                "DELETE FROM telegram_persistence_entries WHERE kind = ? AND key = ?;",
+                deletes)
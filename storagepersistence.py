@@ -0,0 +1,809 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Lesser Public License
+# along with this program.  If not, see [http://www.gnu.org/licenses/].
+#
+# SEE: https://github.com/ncurrault/python-telegram-bot-postgres-persistence/
+
+import hashlib
+import logging
+import pickle
+import threading
+import time
+import zlib
+from abc import abstractmethod
+from collections import defaultdict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    cast,
+    DefaultDict,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None # only needed for compression='zstd'
+
+from telegram.ext import BasePersistence
+from telegram.ext.utils.types import UD, CD, BD, ConversationDict, CDCData
+from telegram.ext.contexttypes import ContextTypes
+
+# stored data starts with a header byte naming its encoding; plain pickles
+# (protocol 2 and up) already start with the PROTO opcode, so rows written
+# before compression existed decode unchanged
+HEADER_PICKLE = b'\x80'
+HEADER_ZLIB = b'z'
+HEADER_ZSTD = b's'
+
+MISSING = object()
+
+def peek(entries: Dict, key: Any) -> Any:
+    """
+    The value stored under key, or MISSING if there is none or it has not
+    been fetched yet. Never fetches anything from storage.
+    """
+    return dict.get(entries, key, MISSING)
+
+def entry_keys(entries: Dict) -> Set:
+    """
+    Every key of entries, fetched or not. Never fetches anything.
+    """
+    return set(dict.keys(entries)) | getattr(entries, 'pending', set())
+
+class LazyEntries:
+    """
+    Mixin for dicts whose values are only fetched, by loader(key), the first
+    time their key is accessed. pending holds the keys known to exist whose
+    values have not been fetched yet. Anything that needs every value
+    (comparing, copying, pickling, values() and items()) fetches the rest
+    first; iterating over the keys never does, as PTB's Dispatcher lists
+    them after every update.
+    """
+
+    def _init_lazy(self, loader: Callable[[Any], Any], pending: Iterable) -> None:
+        self.loader = loader
+        self.pending = set(pending)
+        self.hydrate_lock = threading.Lock()
+
+    def _hydrate(self, key: Any) -> Any:
+        with self.hydrate_lock:
+            if key in self.pending:
+                super().__setitem__(key, self.loader(key))
+                self.pending.discard(key)
+        return super().__getitem__(key)
+
+    def hydrate_all(self) -> None:
+        for key in list(self.pending):
+            self._hydrate(key)
+
+    def derive(self, transform: Callable[[Any], Any]) -> 'LazyEntries':
+        """
+        A new container of the same kind holding transform(value) for every
+        value: applied now to the values already fetched, and on fetch to the
+        others.
+        """
+        loader = self.loader
+        derived = self._new(lambda key: transform(loader(key)), self.pending)
+        for key, value in dict.items(self):
+            dict.__setitem__(derived, key, transform(value))
+        return derived
+
+    def __getitem__(self, key: Any) -> Any:
+        if key in self.pending:
+            return self._hydrate(key)
+        return super().__getitem__(key)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key in self.pending:
+            return self._hydrate(key)
+        return super().get(key, default)
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        if key in self.pending:
+            return self._hydrate(key)
+        return super().setdefault(key, default)
+
+    def pop(self, key: Any, *default: Any) -> Any:
+        if key in self.pending:
+            self._hydrate(key)
+        return super().pop(key, *default)
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.pending.discard(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key: Any) -> None:
+        if key in self.pending:
+            self.pending.discard(key)
+            return
+        super().__delitem__(key)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self.pending or super().__contains__(key)
+
+    def __len__(self) -> int:
+        return super().__len__() + len(self.pending)
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self) -> None:
+        self.pending.clear()
+        super().clear()
+
+    def __iter__(self) -> Any:
+        return iter(entry_keys(self))
+
+    def keys(self) -> Any:
+        return entry_keys(self)
+
+    def values(self) -> Any:
+        self.hydrate_all()
+        return super().values()
+
+    def items(self) -> Any:
+        self.hydrate_all()
+        return super().items()
+
+    def popitem(self) -> Any:
+        self.hydrate_all()
+        return super().popitem()
+
+    def __eq__(self, other: object) -> bool:
+        self.hydrate_all()
+        if isinstance(other, LazyEntries):
+            other.hydrate_all()
+        return super().__eq__(other)
+
+    def __ne__(self, other: object) -> bool:
+        return not self == other
+
+    def __repr__(self) -> str:
+        self.hydrate_all()
+        return super().__repr__()
+
+    def copy(self) -> Dict:
+        self.hydrate_all()
+        return self.plain()
+
+    def __reduce_ex__(self, protocol: Any) -> Any:
+        self.hydrate_all()
+        return self.plain().__reduce_ex__(protocol)
+
+class LazyDict(LazyEntries, dict):
+    def __init__(self, loader: Callable[[Any], Any], pending: Iterable):
+        super().__init__()
+        self._init_lazy(loader, pending)
+
+    def _new(self, loader: Callable[[Any], Any], pending: Iterable) -> 'LazyDict':
+        return LazyDict(loader, pending)
+
+    def plain(self) -> Dict:
+        return dict(dict.items(self))
+
+class LazyDefaultDict(LazyEntries, defaultdict):
+    def __init__(self, default_factory: Any, loader: Callable[[Any], Any], pending: Iterable):
+        super().__init__(default_factory)
+        self._init_lazy(loader, pending)
+
+    def _new(self, loader: Callable[[Any], Any], pending: Iterable) -> 'LazyDefaultDict':
+        return LazyDefaultDict(self.default_factory, loader, pending)
+
+    def plain(self) -> DefaultDict:
+        return defaultdict(self.default_factory, dict.items(self))
+
+
+class StoragePersistence(BasePersistence[UD, CD, BD]):
+    """
+    Pickles the bot's data into a database, either as a whole snapshot on
+    every dump or, in incremental mode, as one row per user, chat, bot_data
+    key and conversation. Subclasses implement the storage backend: reading
+    and writing snapshots and entries.
+    """
+
+    __slots__ = (
+        'on_flush',
+        'user_data',
+        'chat_data',
+        'bot_data',
+        'callback_data',
+        'conversations',
+        'context_types',
+        'incremental',
+        'dirty',
+        'digests',
+        'versions',
+        'state_lock',
+        'dump_lock',
+        'write_behind',
+        'changed',
+        'stop_writing',
+        'writer_thread',
+        'compression',
+        'keep_snapshots',
+        'prune_interval',
+        'last_prune',
+        'prune_thread',
+        'metrics',
+        'logger',
+        'loaded',
+    )
+
+    def __init__(
+        self,
+        store_user_data: bool = True,
+        store_chat_data: bool = True,
+        store_bot_data: bool = True,
+        on_flush: bool = True,
+        store_callback_data: bool = False,
+        context_types: ContextTypes[Any, UD, CD, BD] = None,
+        incremental: bool = False,
+        compression: Optional[str] = None,
+        keep_snapshots: Optional[int] = None,
+        prune_interval: float = 600.0,
+        write_behind: Optional[float] = None,
+    ):
+        super().__init__(
+            store_user_data=store_user_data,
+            store_chat_data=store_chat_data,
+            store_bot_data=store_bot_data,
+            store_callback_data=store_callback_data,
+        )
+
+        self.on_flush = on_flush
+        self.user_data: Optional[DefaultDict[int, UD]] = None
+        self.chat_data: Optional[DefaultDict[int, CD]] = None
+        self.bot_data: Optional[BD] = None
+        self.callback_data: Optional[CDCData] = None
+        self.conversations: Optional[Dict[str, Dict[Tuple, object]]] = None
+        self.context_types = cast(ContextTypes[Any, UD, CD, BD], context_types or ContextTypes())
+
+        # in incremental mode, every user's, chat's and bot_data key's data is
+        # stored as its own row, and only the rows that changed get written
+        # (bot_data keys and conversation names must be strings)
+        self.incremental = incremental
+        self.dirty: Set[Tuple[str, Any]] = set()
+        self.digests: Dict[Tuple[str, Any], bytes] = {}
+        # the version of every stored value that has one, as it was when it
+        # was stored; see _unchanged
+        self.versions: Dict[Tuple[str, Any], int] = {}
+
+        # held while the stored state is mutated or serialized, so a dump on
+        # another thread never sees it half-updated; dumps themselves take turns
+        self.state_lock = threading.RLock()
+        self.dump_lock = threading.Lock()
+
+        # with write_behind set, updates only mark the state as changed and a
+        # background thread dumps it, coalescing all the updates that arrive
+        # within write_behind seconds of the first one into a single write
+        self.write_behind = write_behind
+        self.changed = threading.Event()
+        self.stop_writing = threading.Event()
+        self.writer_thread: Optional[threading.Thread] = None
+
+        if compression not in (None, 'zlib', 'zstd'):
+            raise ValueError(f"Unknown compression {compression!r}")
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("compression='zstd' needs the zstandard package")
+        self.compression = compression
+
+        # snapshots past the newest keep_snapshots (None to keep them all) are
+        # pruned in the background, at most once every prune_interval seconds
+        if keep_snapshots is not None and keep_snapshots < 1:
+            raise ValueError(f"keep_snapshots must be None or at least 1, not {keep_snapshots!r}")
+        self.keep_snapshots = keep_snapshots
+        self.prune_interval = prune_interval
+        self.last_prune = 0.0
+        self.prune_thread: Optional[threading.Thread] = None
+
+        self.metrics: Dict[str, float] = {
+            'snapshot_bytes': 0, # encoded size of the last snapshot loaded or dumped
+            'snapshot_raw_bytes': 0, # same, before compression
+            'encode_seconds': 0.0, # time taken to pickle and compress it
+            'decode_seconds': 0.0, # time taken to decompress and unpickle the last load
+            'entry_bytes_written': 0, # encoded bytes of all entries upserted so far
+            'snapshots_pruned': 0,
+        }
+        self.logger = logging.getLogger(type(self).__module__)
+
+        # state is loaded once, on first access; in incremental mode only the
+        # list of entries is loaded then, and each user's, chat's and bot_data
+        # key's data is fetched the first time it is used
+        self.loaded = False
+
+    # --- storage backend ---
+
+    @abstractmethod
+    def _read_snapshot(self) -> Optional[bytes]:
+        """
+        The newest snapshot, or None if there is none.
+        """
+
+    @abstractmethod
+    def _write_snapshot(self, data: bytes) -> None:
+        """
+        Store data as the newest snapshot.
+        """
+
+    @abstractmethod
+    def _delete_snapshots(self, keep: int) -> int:
+        """
+        Delete all but the newest keep snapshots, returning how many were deleted.
+        """
+
+    @abstractmethod
+    def _read_entries(self, lazy_kinds: Tuple[str, ...]) -> Optional[List[Tuple[str, str, Optional[bytes]]]]:
+        """
+        Every stored entry as (kind, key, data), with data left out (None) for
+        entries of lazy_kinds. If there is no table of entries yet, creates it
+        and returns None.
+        """
+
+    @abstractmethod
+    def _read_entry(self, kind: str, key: str) -> bytes:
+        """
+        The data of a single stored entry.
+        """
+
+    @abstractmethod
+    def _write_entries(self, upserts: List[Tuple[str, str, bytes]], deletes: List[Tuple[str, str]]) -> None:
+        """
+        Insert or replace the (kind, key, data) entries in upserts and delete
+        the (kind, key) entries in deletes, in a single transaction.
+        """
+
+    @abstractmethod
+    def _close(self) -> None:
+        """
+        Release connections; the next read or write opens them again.
+        """
+
+    # --- loading ---
+
+    def _load(self) -> None:
+        if self.incremental:
+            self._load_entries()
+        else:
+            self._load_snapshot()
+        self.loaded = True
+
+    def _ensure_loaded(self) -> None:
+        with self.state_lock:
+            if not self.loaded:
+                self._load()
+
+    def _load_snapshot(self) -> None:
+        try:
+            stored = self._read_snapshot()
+            if stored is None:
+                self.conversations = {}
+                self.user_data = defaultdict(self.context_types.user_data)
+                self.chat_data = defaultdict(self.context_types.chat_data)
+                self.bot_data = self.context_types.bot_data()
+                self.callback_data = None
+            else:
+                start = time.perf_counter()
+                raw = self._decode(bytes(stored))
+                data = pickle.loads(raw)
+                self.metrics['snapshot_bytes'] = len(stored)
+                self.metrics['snapshot_raw_bytes'] = len(raw)
+                self.user_data = defaultdict(self.context_types.user_data, data['user_data'])
+                self.chat_data = defaultdict(self.context_types.chat_data, data['chat_data'])
+                # For backwards compatibility with dumps not containing bot data
+                self.bot_data = data.get('bot_data', self.context_types.bot_data())
+                self.callback_data = data.get('callback_data', {})
+                self.conversations = data['conversations']
+                for kind in ('user_data', 'chat_data', 'bot_data'):
+                    for key, value in dict.items(getattr(self, kind)):
+                        self._record_version(kind, key, value)
+                self.metrics['decode_seconds'] = time.perf_counter() - start
+                self.logger.info("Loaded %d byte snapshot in %.3fs",
+                    self.metrics['snapshot_bytes'], self.metrics['decode_seconds'])
+        except pickle.UnpicklingError as exc:
+            raise TypeError(f"Database does not contain valid pickle data") from exc
+        except Exception as exc:
+            raise TypeError(f"Something went wrong loading from database/unpickling") from exc
+
+    def _load_entries(self) -> None:
+        lazy_kinds: Tuple[str, ...] = ('user_data', 'chat_data')
+        if self.context_types.bot_data is dict:
+            lazy_kinds += ('bot_data',)
+
+        try:
+            rows = self._read_entries(lazy_kinds)
+        except Exception as exc:
+            raise TypeError(f"Something went wrong loading from database") from exc
+
+        if rows is None:
+            # first start in incremental mode: carry over the latest snapshot,
+            # writing all of it out as entries on the next dump
+            self._load_snapshot()
+            with self.state_lock:
+                self.dirty.update(self._all_entries())
+            return
+
+        pending: Dict[str, List] = { kind: [] for kind in lazy_kinds }
+        for kind, key, _ in rows:
+            if kind in pending:
+                pending[kind].append(self._parse_key(kind, key))
+
+        self.conversations = {}
+        self.user_data = LazyDefaultDict(self.context_types.user_data,
+            lambda key: self._fetch_entry('user_data', key), pending['user_data'])
+        self.chat_data = LazyDefaultDict(self.context_types.chat_data,
+            lambda key: self._fetch_entry('chat_data', key), pending['chat_data'])
+        if 'bot_data' in pending:
+            self.bot_data = LazyDict(lambda key: self._fetch_entry('bot_data', key), pending['bot_data'])
+        else:
+            self.bot_data = self.context_types.bot_data()
+        self.callback_data = None
+        self.digests = {}
+        self.versions = {}
+
+        try:
+            start = time.perf_counter()
+            for kind, key, data in rows:
+                if kind in pending:
+                    continue
+                key = self._parse_key(kind, key)
+                value = self._decode_entry(kind, key, data)
+                if kind == 'callback_data':
+                    self.callback_data = value
+                else:
+                    getattr(self, kind)[key] = value
+            self.metrics['decode_seconds'] = time.perf_counter() - start
+            self.logger.info("Loaded index of %d entries in %.3fs", len(rows), self.metrics['decode_seconds'])
+        except pickle.UnpicklingError as exc:
+            raise TypeError(f"Database does not contain valid pickle data") from exc
+        except Exception as exc:
+            raise TypeError(f"Something went wrong loading from database/unpickling") from exc
+
+    @staticmethod
+    def _parse_key(kind: str, key: str) -> Any:
+        return int(key) if kind in ('user_data', 'chat_data') else key
+
+    def _decode_entry(self, kind: str, key: Any, data: bytes) -> Any:
+        raw = self._decode(bytes(data))
+        self.digests[(kind, key)] = self._digest(raw)
+        value = pickle.loads(raw)
+        self._record_version(kind, key, value)
+        return value
+
+    def _fetch_entry(self, kind: str, key: Any) -> Any:
+        try:
+            return self._decode_entry(kind, key, self._read_entry(kind, str(key)))
+        except Exception as exc:
+            raise TypeError(f"Something went wrong loading {kind} {key!r} from database/unpickling") from exc
+
+    def insert_bot(self, obj: object) -> object:
+        # PTB copies all of user_data/chat_data/bot_data on the way in and out
+        # of persistence; for lazily fetched containers, only copy the values
+        # that have been fetched, and the rest whenever they are
+        if isinstance(obj, LazyEntries):
+            return obj.derive(super().insert_bot)
+        return super().insert_bot(obj)
+
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        if isinstance(obj, LazyEntries):
+            return obj.derive(super().replace_bot)
+        return super().replace_bot(obj)
+
+    # --- dumping ---
+
+    def _dump(self) -> None:
+        with self.dump_lock:
+            if self.incremental:
+                self._dump_entries()
+            else:
+                self._dump_snapshot()
+
+    def _dump_snapshot(self) -> None:
+        start = time.perf_counter()
+        with self.state_lock:
+            data = {
+                'conversations': self.conversations,
+                'user_data': self.user_data,
+                'chat_data': self.chat_data,
+                'bot_data': self.bot_data,
+                'callback_data': self.callback_data,
+            }
+            raw = pickle.dumps(data)
+        data_serialized = self._encode(raw)
+        self.metrics['encode_seconds'] = time.perf_counter() - start
+        self.metrics['snapshot_bytes'] = len(data_serialized)
+        self.metrics['snapshot_raw_bytes'] = len(raw)
+
+        self._write_snapshot(data_serialized)
+        self.logger.debug("Dumped %d byte snapshot (%d before compression), encoded in %.3fs",
+            len(data_serialized), len(raw), self.metrics['encode_seconds'])
+        self._schedule_prune()
+
+    def _schedule_prune(self) -> None:
+        if self.keep_snapshots is None or time.monotonic() - self.last_prune < self.prune_interval:
+            return
+        if self.prune_thread is not None and self.prune_thread.is_alive():
+            return
+        self.last_prune = time.monotonic()
+        self.prune_thread = threading.Thread(target=self._prune_snapshots,
+            name=f"{type(self).__name__}:prune", daemon=True)
+        self.prune_thread.start()
+
+    def _prune_snapshots(self) -> None:
+        try:
+            deleted = self._delete_snapshots(cast(int, self.keep_snapshots))
+        except Exception:
+            self.logger.exception("Failed to prune old snapshots")
+            return
+        self.metrics['snapshots_pruned'] += deleted
+        if deleted > 0:
+            self.logger.info("Pruned %d old snapshots", deleted)
+
+    def _encode(self, raw: bytes) -> bytes:
+        if self.compression == 'zlib':
+            return HEADER_ZLIB + zlib.compress(raw)
+        if self.compression == 'zstd':
+            return HEADER_ZSTD + zstandard.ZstdCompressor().compress(raw)
+        return raw
+
+    @staticmethod
+    def _decode(data: bytes) -> bytes:
+        header, body = data[:1], data[1:]
+        if header == HEADER_PICKLE:
+            return data
+        if header == HEADER_ZLIB:
+            return zlib.decompress(body)
+        if header == HEADER_ZSTD:
+            if zstandard is None:
+                raise TypeError("Database contains zstd-compressed data, but zstandard is not installed")
+            return zstandard.ZstdDecompressor().decompress(body)
+        raise pickle.UnpicklingError(f"Unknown encoding header {header!r}")
+
+    def _dump_entries(self) -> None:
+        upserts = []
+        deletes = []
+        digests: Dict[Tuple[str, Any], Optional[bytes]] = {}
+
+        with self.state_lock:
+            dirty, self.dirty = self.dirty, set()
+            serialized = {}
+            for kind, key in dirty:
+                exists, value = self._lookup(kind, key)
+                serialized[(kind, key)] = pickle.dumps(value) if exists else None
+
+        for (kind, key), data in serialized.items():
+            if data is None:
+                deletes.append((kind, str(key)))
+                digests[(kind, key)] = None
+                continue
+
+            digest = self._digest(data)
+            if self.digests.get((kind, key)) != digest:
+                upserts.append((kind, str(key), self._encode(data)))
+                digests[(kind, key)] = digest
+
+        if len(upserts) == 0 and len(deletes) == 0:
+            return
+
+        try:
+            self._write_entries(upserts, deletes)
+        except Exception:
+            with self.state_lock:
+                self.dirty.update(dirty) # try again on the next dump
+            raise
+        self.metrics['entry_bytes_written'] += sum(len(data) for _, _, data in upserts)
+
+        for entry, digest in digests.items():
+            if digest is None:
+                self.digests.pop(entry, None)
+            else:
+                self.digests[entry] = digest
+
+    @staticmethod
+    def _digest(data: bytes) -> bytes:
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def _lookup(self, kind: str, key: Any) -> Tuple[bool, Any]:
+        if kind == 'callback_data':
+            return self.callback_data is not None, self.callback_data
+        entries = getattr(self, kind)
+        if entries is None or key not in entries:
+            return False, None
+        return True, entries[key]
+
+    def _all_entries(self) -> Iterator[Tuple[str, Any]]:
+        for kind in ('user_data', 'chat_data', 'bot_data', 'conversations'):
+            for key in getattr(self, kind) or {}:
+                yield kind, key
+        if self.callback_data is not None:
+            yield 'callback_data', ''
+
+    def _record_version(self, kind: str, key: Any, value: Any) -> None:
+        version = getattr(value, 'version', None)
+        if version is None:
+            self.versions.pop((kind, key), None)
+        else:
+            self.versions[(kind, key)] = version
+
+    def _unchanged(self, kind: str, key: Any, old: Any, new: Any) -> bool:
+        """
+        Whether new, about to be stored under key, is the same as old, which
+        may be MISSING. Values with a version attribute that they bump on
+        every change (like the bot's polls) are compared by version, in
+        constant time, instead of with ==. The version they had when stored
+        is recorded rather than read off old, which needn't be a copy: if
+        PTB fails to copy a value, it hands over the live object.
+        """
+        if old is MISSING or old is new:
+            return False
+        version = getattr(new, 'version', None)
+        if version is not None:
+            return self.versions.get((kind, key)) == version
+        return old == new
+
+    def _mark_dirty(self, kind: str, key: Any) -> None:
+        if self.incremental:
+            with self.state_lock:
+                self.dirty.add((kind, key))
+
+    def _state_changed(self) -> None:
+        if self.write_behind is not None:
+            self._start_writer()
+            self.changed.set()
+        elif not self.on_flush:
+            self._dump()
+
+    def _start_writer(self) -> None:
+        with self.state_lock:
+            if self.writer_thread is None and not self.stop_writing.is_set():
+                self.writer_thread = threading.Thread(target=self._write_behind,
+                    name=f"{type(self).__name__}:write_behind", daemon=True)
+                self.writer_thread.start()
+
+    def _write_behind(self) -> None:
+        while True:
+            self.changed.wait()
+            # let the rest of this burst of updates arrive (unless shutting down)
+            if self.stop_writing.wait(self.write_behind):
+                return # flush() writes whatever is left
+            self.changed.clear()
+            try:
+                self._dump()
+            except Exception:
+                self.logger.exception("Write-behind dump failed, retrying")
+                self.changed.set()
+
+    def _stop_writer(self) -> None:
+        self.stop_writing.set()
+        self.changed.set()
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+
+    # --- BasePersistence ---
+
+    def get_user_data(self) -> DefaultDict[int, UD]:
+        self._ensure_loaded()
+        return self.user_data  # type: ignore[return-value]
+
+    def get_chat_data(self) -> DefaultDict[int, CD]:
+        self._ensure_loaded()
+        return self.chat_data  # type: ignore[return-value]
+
+    def get_bot_data(self) -> BD:
+        self._ensure_loaded()
+        return self.bot_data  # type: ignore[return-value]
+
+    def get_callback_data(self) -> Optional[CDCData]:
+        self._ensure_loaded()
+        if self.callback_data is None:
+            return None
+        return self.callback_data[0], self.callback_data[1].copy()
+
+    def get_conversations(self, name: str) -> ConversationDict:
+        self._ensure_loaded()
+        return self.conversations.get(name, {}).copy()  # type: ignore[union-attr]
+
+    def update_conversation(
+        self, name: str, key: Tuple[int, ...], new_state: Optional[object]
+    ) -> None:
+        with self.state_lock:
+            if not self.conversations:
+                self.conversations = {}
+            if self.conversations.setdefault(name, {}).get(key) == new_state:
+                return
+            self.conversations[name][key] = new_state
+            self._mark_dirty('conversations', name)
+        self._state_changed()
+
+    def update_user_data(self, user_id: int, data: UD) -> None:
+        with self.state_lock:
+            if self.user_data is None:
+                self.user_data = defaultdict(self.context_types.user_data)
+            if self._unchanged('user_data', user_id, peek(self.user_data, user_id), data):
+                return
+            self.user_data[user_id] = data
+            self._record_version('user_data', user_id, data)
+            self._mark_dirty('user_data', user_id)
+        self._state_changed()
+
+    def update_chat_data(self, chat_id: int, data: CD) -> None:
+        with self.state_lock:
+            if self.chat_data is None:
+                self.chat_data = defaultdict(self.context_types.chat_data)
+            if self._unchanged('chat_data', chat_id, peek(self.chat_data, chat_id), data):
+                return
+            self.chat_data[chat_id] = data
+            self._record_version('chat_data', chat_id, data)
+            self._mark_dirty('chat_data', chat_id)
+        self._state_changed()
+
+    def update_bot_data(self, data: BD) -> None:
+        with self.state_lock:
+            old_data = self.bot_data or {}
+            changed = False
+            for key in entry_keys(old_data) | entry_keys(data):
+                old_value, new_value = peek(old_data, key), peek(data, key)
+                if key not in data:
+                    changed = True
+                    self._mark_dirty('bot_data', key)
+                    self.versions.pop(('bot_data', key), None)
+                elif new_value is MISSING:
+                    continue # never fetched, so it can't have changed
+                elif not self._unchanged('bot_data', key, old_value, new_value):
+                    changed = True
+                    self._mark_dirty('bot_data', key)
+                    self._record_version('bot_data', key, new_value)
+            if not changed and entry_keys(old_data) == entry_keys(data):
+                return
+            self.bot_data = data
+        self._state_changed()
+
+    def update_callback_data(self, data: CDCData) -> None:
+        with self.state_lock:
+            if self.callback_data == data:
+                return
+            self.callback_data = (data[0], data[1].copy())
+            self._mark_dirty('callback_data', '')
+        self._state_changed()
+
+    def refresh_user_data(self, user_id: int, user_data: UD) -> None:
+        pass # do nothing
+
+    def refresh_chat_data(self, chat_id: int, chat_data: CD) -> None:
+        pass # do nothing
+
+    def refresh_bot_data(self, bot_data: BD) -> None:
+        pass # do nothing
+
+    def flush(self) -> None:
+        self._stop_writer()
+        if (
+            self.user_data
+            or self.chat_data
+            or self.bot_data
+            or self.callback_data
+            or self.conversations
+        ):
+            self._dump()
+        if self.prune_thread is not None:
+            self.prune_thread.join()
+        self._close()